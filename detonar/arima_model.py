@@ -0,0 +1,130 @@
+"""
+ARIMA models used by the IDS and by the attack classification:
+order search with auto_arima
+refit with the order of the last search, which is cached for each node and feature
+update of a fitted model with each new observation between two full fits
+"""
+import warnings
+from collections import namedtuple
+
+import numpy as np
+import pmdarima as pm
+
+warnings.filterwarnings("ignore")
+
+# Order found by the last auto_arima search on the series of a node and feature
+# selected_at: window of the search
+# residual_std: standard deviation of the in-sample residuals of the searched model
+ArimaOrder = namedtuple(
+    "ArimaOrder", ["order", "with_intercept", "selected_at", "residual_std"]
+)
+
+# Model of a series kept between windows, without the fitted model so that it is cheap
+# to send to other processes
+# model_params: parameters the model is built with, see pm.ARIMA.get_params
+# endog: series the model is fitted on, including the updates
+# params: fitted parameters of the model
+# fitted_at: window of the last full fit, the model is updated in the windows after it
+ArimaState = namedtuple("ArimaState", ["model_params", "endog", "params", "fitted_at"])
+
+# A refit whose residuals are this many times larger than those of the search
+# triggers a new search
+RESIDUAL_DRIFT = 2.0
+
+
+def auto_arima(train):
+    return pm.auto_arima(
+        train,
+        start_p=1,
+        start_q=1,
+        test="adf",  # use adftest to find optimal 'd'
+        max_p=3,
+        max_q=3,  # maximum p and q
+        m=1,  # frequency of series
+        d=None,  # let model determine 'd'
+        seasonal=False,  # No Seasonality
+        start_P=0,
+        D=0,  # Minimum differencing order
+        trace=False,
+        error_action="ignore",
+        suppress_warnings=True,
+        stepwise=True,
+    )
+
+
+def _refit(train, arima_order):
+    # Fit with a fixed order, None if it fails or if its residuals drifted
+    try:
+        model = pm.ARIMA(
+            order=arima_order.order,
+            with_intercept=arima_order.with_intercept,
+            suppress_warnings=True,
+        ).fit(train)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    if np.std(model.resid()) > RESIDUAL_DRIFT * arima_order.residual_std + 1e-8:
+        return None
+    return model
+
+
+def fit_arima(train, window, arima_order=None, reselect_every=1):
+    """
+    Fit an ARIMA model on train. The order is searched with auto_arima if there is no
+    cached order, if the cached order was searched reselect_every windows ago or more,
+    or if the residuals of the refit with the cached order drifted.
+    :param window: index of the window that is forecast
+    :param arima_order: order cached for the series, None if there is none
+    :return: fitted model and order to cache for the next window
+    """
+    if arima_order is not None and window - arima_order.selected_at < reselect_every:
+        model = _refit(train, arima_order)
+        if model is not None:
+            return model, arima_order
+    model = auto_arima(train)
+    return model, ArimaOrder(
+        model.order, model.with_intercept, window, float(np.std(model.resid()))
+    )
+
+
+def _get_state(model, fitted_at):
+    return ArimaState(
+        model.get_params(),
+        np.asarray(model.arima_res_.data.endog, dtype=float).ravel(),
+        np.asarray(model.arima_res_.params),
+        fitted_at,
+    )
+
+
+def _update(arima_state, observations):
+    # Same as ARIMA.update of the kept model: fit on the series with the new observations,
+    # starting from the fitted parameters with a few iterations
+    return pm.ARIMA(**arima_state.model_params).fit(
+        np.append(arima_state.endog, observations),
+        start_params=arima_state.params,
+        maxiter=max(5, len(observations) // 10),
+    )
+
+
+def update_or_fit_arima(
+    history, window, arima_state, arima_order=None, reselect_every=1, refit_every=1
+):
+    """
+    Update the kept model of a series with the last observation of history, or fit it
+    on the whole history if there is no kept model or if it was fitted refit_every
+    windows ago or more. Full fits use the cached order, see fit_arima.
+    :param history: history of the series, its last value is the new observation
+    :param arima_state: model kept for the series, None if there is none
+    :return: model, model to keep and order to cache for the next window
+    """
+    if arima_state is not None and window - arima_state.fitted_at < refit_every:
+        try:
+            model = _update(arima_state, history[-1:])
+            return model, _get_state(model, arima_state.fitted_at), arima_order
+        except Exception:  # pylint: disable=broad-except
+            pass
+    model, arima_order = fit_arima(history, window, arima_order, reselect_every)
+    # Models are only kept if they are updated in the next windows
+    if refit_every <= 1:
+        return model, None, arima_order
+    return model, _get_state(model, window), arima_order
+
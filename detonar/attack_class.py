@@ -3,7 +3,8 @@ import math
 import warnings
 
 import numpy as np
-import pmdarima as pm
+
+import detectors
 
 warnings.filterwarnings("ignore")
 
@@ -29,29 +30,27 @@ def variational_coefficient(series):
     return np.std(np.asarray(series)) / np.mean(np.asarray(series))
 
 
-def check_feature_with_arima(train, real_value, args):
+def check_feature_with_detector(
+    train, real_value, args, detectors_dict=None, key=None, window=0
+):
+    # With a dict of detectors and a key (node, feature), the detector of the series is
+    # kept in the dict, so that the ARIMA order is cached
     conf_int = [[0, 0]]
+    degenerate, _, interval = detectors.degenerate_intervals(train, args.alpha)
+    if degenerate:
+        # Constant or near constant history, closed-form interval without a detector
+        detectors.path_counts["degenerate"] += 1
+        return real_value < interval[0] or real_value > interval[1]
+    detectors.path_counts["detector"] += 1
     try:
-        model = pm.auto_arima(
-            train,
-            start_p=1,
-            start_q=1,
-            test="adf",  # use adftest to find optimal 'd'
-            max_p=3,
-            max_q=3,  # maximum p and q
-            m=1,  # frequency of series
-            d=None,  # let model determine 'd'
-            seasonal=False,  # No Seasonality
-            start_P=0,
-            D=0,  # Minimum differencing order
-            trace=False,
-            error_action="ignore",
-            suppress_warnings=True,
-            stepwise=True,
-        )
-        output, conf_int = model.predict(
-            n_periods=1, return_conf_int=True, alpha=args.alpha
-        )
+        if detectors_dict is None or key is None:
+            detector = detectors.get_detector(args)
+        else:
+            if key not in detectors_dict:
+                detectors_dict[key] = detectors.get_detector(args)
+            detector = detectors_dict[key]
+        detector.fit(train, window)
+        output, conf_int = detector.predict_interval(args.alpha)
     except:
         pass
     if real_value < conf_int[0][0] or real_value > conf_int[0][1]:
@@ -87,7 +86,7 @@ def extract_feature_before_and_after(features_series, nodes, time_step, args):
             if feature == "# APP txd":
                 train = feature_s[time_step - 30 : time_step]
                 ground_truth = feature_s[time_step]
-                attack_class_dict[feature] = check_feature_with_arima(
+                attack_class_dict[feature] = check_feature_with_detector(
                     train, ground_truth
                 )
             if feature == "# DIO txd":
@@ -442,7 +441,10 @@ def classify_attack_from_dodag(
     list_nodes_train,
     output_file,
     args,
+    detectors_dict=None,
 ):
+    # detectors_dict: detectors of the checked series by (node, feature), kept between
+    # calls for the same simulation
     # Create list of features for attack classification
     all_features = args.attack_classification_features.copy()
     all_features.extend(
@@ -470,6 +472,12 @@ def classify_attack_from_dodag(
         nodes_and_features_dict["SINKNODE-1"] = {
             feature: False for feature in all_features
         }
+    # Nodes joining the network after the training are checked as the others
+    for node_name in list(anomalous_nodes) + list(nodes_changing):
+        if node_name not in nodes_and_features_dict:
+            nodes_and_features_dict[node_name] = {
+                feature: False for feature in all_features
+            }
     # Check if list of communicating nodes is equal to the list obtained from training
     # Removed as it doesn't work with BR approach and Blackhole attack
     # anomalous_nodes, nodes_and_features_dict, change_in_communicating_nodes = \
@@ -509,8 +517,15 @@ def classify_attack_from_dodag(
             if feature_class == "# APP txd" or feature_class == "incoming_vs_outgoing":
                 train = feature_s[time_step - 30 : time_step]
                 ground_truth = feature_s[time_step]
-                nodes_and_features_dict[node][feature_class] = check_feature_with_arima(
-                    train, ground_truth, args
+                nodes_and_features_dict[node][feature_class] = (
+                    check_feature_with_detector(
+                        train,
+                        ground_truth,
+                        args,
+                        detectors_dict=detectors_dict,
+                        key=(node, feature_class),
+                        window=time_step,
+                    )
                 )
             if feature_class == "# DIO txd":
                 train = feature_s[:time_step]
@@ -0,0 +1,60 @@
+"""
+Batched AR(p) / ARI(p, d) forecaster:
+fit an AR model on the (differenced) history of every node at once with least squares
+one-step forecast and Gaussian prediction interval of every node
+"""
+from math import comb
+
+import numpy as np
+from scipy.stats import norm
+
+# Ridge added to the normal equations so that constant histories can be solved
+_RIDGE = 1e-8
+
+
+def _design_matrices(series, order):
+    """
+    Build the lagged design matrices of all series
+    :param series: (node x time) array
+    :return: (node x rows x order + 1) design matrices with intercept and
+        (node x rows) targets
+    """
+    n_nodes, length = series.shape
+    rows = length - order
+    lags = [series[:, order - lag : length - lag] for lag in range(1, order + 1)]
+    design = np.stack([np.ones((n_nodes, rows))] + lags, axis=2)
+    return design, series[:, order:]
+
+
+def forecast_intervals(histories, alpha, order=2, diff=1):
+    """
+    Forecast the next value of every series with an ARI(order, diff) model and its
+    Gaussian prediction interval
+    :param histories: (node x time) array of histories
+    :param alpha: the interval covers 1 - alpha of the forecast distribution
+    :return: (node) array of forecasts and (node x 2) array of intervals
+    """
+    histories = np.asarray(histories, dtype=float)
+    differenced = np.diff(histories, n=diff, axis=1)
+    design, targets = _design_matrices(differenced, order)
+    # Least squares of all nodes at once through the normal equations
+    gram = np.einsum("nrk,nrl->nkl", design, design) + _RIDGE * np.eye(order + 1)
+    gram_inv = np.linalg.inv(gram)
+    coefficients = np.einsum("nkl,nrl,nr->nk", gram_inv, design, targets)
+    residuals = targets - np.einsum("nrk,nk->nr", design, coefficients)
+    dof = max(targets.shape[1] - (order + 1), 1)
+    variance = np.sum(residuals**2, axis=1) / dof
+
+    # One-step forecast of the differenced series
+    last_lags = np.concatenate(
+        [np.ones((len(histories), 1)), differenced[:, ::-1][:, :order]], axis=1
+    )
+    forecasts = np.einsum("nk,nk->n", last_lags, coefficients)
+    # Undo the differencing with the last values of the history, which are known
+    for lag in range(1, diff + 1):
+        forecasts += (-1) ** (lag + 1) * comb(diff, lag) * histories[:, -lag]
+
+    # Prediction variance includes the uncertainty of the coefficients
+    leverage = np.einsum("nk,nkl,nl->n", last_lags, gram_inv, last_lags)
+    half_width = norm.ppf(1 - alpha / 2) * np.sqrt(variance * (1 + leverage))
+    return forecasts, np.stack([forecasts - half_width, forecasts + half_width], axis=1)
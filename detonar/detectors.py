@@ -0,0 +1,275 @@
+"""
+Anomaly detectors of the IDS and of the attack classification.
+A detector forecasts the next value of the series of a node and feature, and the interval
+of values considered normal:
+fit(history, window): fit the detector on the history before window
+update(observation): add the observation of the next window
+predict_interval(alpha): forecast and (1 x 2) interval covering 1 - alpha
+The detector used is selected by name with the forecaster setting.
+Constant and near constant histories get a closed-form interval without a detector.
+"""
+from collections import Counter
+
+import numpy as np
+from scipy.stats import norm
+
+import arima_model
+import batch_ar
+from ring_buffer import RingBuffer
+
+
+# Histories with at most this many values different from their median are degenerate
+DEGENERATE_OUTLIERS = 1
+# Minimum half width of the interval of degenerate histories, the half width of the
+# interval used when a model cannot be fitted
+DEGENERATE_HALF_WIDTH = 0.1
+
+# Number of forecasts made by each path: "degenerate" (closed form), "cached" (forecast
+# cache) or "detector"
+path_counts = Counter()
+
+
+def degenerate_intervals(histories, alpha):
+    """
+    Find constant and near constant histories, which need no model. Their forecast is the
+    median of the history and their interval is Gaussian with the standard deviation of
+    the history, with a half width of at least DEGENERATE_HALF_WIDTH.
+    :param histories: (... x time) array of histories
+    :return: (...) mask of degenerate histories, (...) forecasts and (... x 2) intervals
+    """
+    histories = np.asarray(histories, dtype=float)
+    median = np.median(histories, axis=-1)
+    degenerate = (
+        np.count_nonzero(histories != median[..., None], axis=-1) <= DEGENERATE_OUTLIERS
+    )
+    half_width = np.maximum(
+        norm.ppf(1 - alpha / 2) * histories.std(axis=-1), DEGENERATE_HALF_WIDTH
+    )
+    return degenerate, median, np.stack([median - half_width, median + half_width], -1)
+
+
+class Detector:
+    """
+    Base class of the detectors, keeping the history window of the series in a ring
+    buffer, history is a contiguous view of it
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self._history = RingBuffer((), 0)
+        self.window = 0
+
+    @property
+    def history(self):
+        return self._history.view()
+
+    def fit(self, history, window=0):
+        history = np.asarray(history, dtype=float)
+        if self._history.size != len(history):
+            self._history = RingBuffer((), len(history))
+        self._history.fill(history)
+        self.window = window
+
+    def update(self, observation):
+        if not self._history.size:
+            raise ValueError(
+                f"{type(self).__name__} is updated before being fit on a history"
+            )
+        self._history.push(observation)
+        self.window += 1
+
+    def predict_interval(self, alpha):
+        raise NotImplementedError
+
+
+def _interval(forecast, half_width):
+    return np.array([forecast]), np.array(
+        [[forecast - half_width, forecast + half_width]]
+    )
+
+
+class AutoArimaDetector(Detector):
+    """
+    ARIMA model searched with auto_arima, see arima_model for the cached order and the
+    updates between full fits
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.model = None
+        self.arima_order = None
+        self.arima_state = None
+
+    def fit(self, history, window=0):
+        super().fit(history, window)
+        # A new history needs a full fit, the cached order is kept
+        self.arima_state = None
+        self._fit()
+
+    def update(self, observation):
+        super().update(observation)
+        self._fit()
+
+    def _fit(self):
+        self.model = None
+        self.model, self.arima_state, self.arima_order = (
+            arima_model.update_or_fit_arima(
+                self.history,
+                self.window,
+                self.arima_state,
+                self.arima_order,
+                self.args.arima_reselect_every,
+                self.args.arima_refit_every,
+            )
+        )
+
+    def predict_interval(self, alpha):
+        return self.model.predict(n_periods=1, return_conf_int=True, alpha=alpha)
+
+    def __getstate__(self):
+        # The fitted model is not sent to other processes, the kept state holds what is
+        # needed to update it
+        state = self.__dict__.copy()
+        state["model"] = None
+        return state
+
+
+class EwmaDetector(Detector):
+    """
+    Exponentially weighted moving average of the series, with the exponentially
+    weighted variance of its one-step errors
+    """
+
+    SMOOTHING = 0.3
+
+    def fit(self, history, window=0):
+        super().fit(history, window)
+        self.level = self.history[0]
+        self.variance = 0.0
+        for observation in self.history[1:]:
+            self._smooth(observation)
+
+    def update(self, observation):
+        super().update(observation)
+        self._smooth(observation)
+
+    def _smooth(self, observation):
+        error = observation - self.level
+        self.level += self.SMOOTHING * error
+        self.variance = (1 - self.SMOOTHING) * (
+            self.variance + self.SMOOTHING * error**2
+        )
+
+    def predict_interval(self, alpha):
+        return _interval(self.level, norm.ppf(1 - alpha / 2) * np.sqrt(self.variance))
+
+
+class HoltDetector(Detector):
+    """
+    Holt linear exponential smoothing of level and trend, with the exponentially weighted
+    variance of its one-step errors
+    """
+
+    SMOOTHING = 0.3
+    TREND_SMOOTHING = 0.1
+
+    def fit(self, history, window=0):
+        super().fit(history, window)
+        self.level = self.history[0]
+        self.trend = self.history[1] - self.history[0] if len(self.history) > 1 else 0.0
+        self.variance = 0.0
+        for observation in self.history[1:]:
+            self._smooth(observation)
+
+    def update(self, observation):
+        super().update(observation)
+        self._smooth(observation)
+
+    def _smooth(self, observation):
+        error = observation - (self.level + self.trend)
+        self.level += self.trend + self.SMOOTHING * error
+        self.trend += self.SMOOTHING * self.TREND_SMOOTHING * error
+        self.variance = (1 - self.SMOOTHING) * (
+            self.variance + self.SMOOTHING * error**2
+        )
+
+    def predict_interval(self, alpha):
+        return _interval(
+            self.level + self.trend, norm.ppf(1 - alpha / 2) * np.sqrt(self.variance)
+        )
+
+
+class MadDetector(Detector):
+    """
+    Robust z-score: median of the history and its median absolute deviation, scaled to
+    the standard deviation of a normal distribution. When more than half of the history
+    equals its median the deviation is 0, the standard deviation of the history is used
+    instead, and the half width is at least DEGENERATE_HALF_WIDTH
+    """
+
+    MAD_SCALE = 1.4826
+
+    def predict_interval(self, alpha):
+        median = np.median(self.history)
+        mad = np.median(np.abs(self.history - median))
+        scale = self.MAD_SCALE * mad if mad > 0 else np.std(self.history)
+        return _interval(
+            median,
+            max(norm.ppf(1 - alpha / 2) * scale, DEGENERATE_HALF_WIDTH),
+        )
+
+
+class BatchArDetector(Detector):
+    """
+    AR model of batch_ar fitted on a single series
+    """
+
+    def predict_interval(self, alpha):
+        forecasts, conf_ints = batch_ar.forecast_intervals(
+            self.history[None], alpha, self.args.ar_order, self.args.ar_diff
+        )
+        return forecasts, conf_ints
+
+
+# Detectors by name of the forecaster setting
+DETECTORS = {
+    "auto_arima": AutoArimaDetector,
+    "batch_ar": BatchArDetector,
+    "ewma": EwmaDetector,
+    "holt": HoltDetector,
+    "mad": MadDetector,
+}
+
+
+def get_config(args):
+    """
+    Settings the forecasts of the selected detector depend on, for the forecast cache
+    :return: config, None if the forecasts do not only depend on the history, because the
+        detector carries state from earlier windows, or if the forecasts are not cached,
+        as for batch_ar which fits all series of a window at once
+    """
+    if args.forecaster == "auto_arima":
+        if args.arima_reselect_every > 1 or args.arima_refit_every > 1:
+            return None
+        return (args.forecaster,)
+    if args.forecaster == "mad":
+        return (args.forecaster,)
+    return None
+
+
+def check_settings(args):
+    # Fail on an unknown forecaster or on settings it does not support before any fit
+    get_detector(args)
+    if args.forecaster == "batch_ar" and args.prescreen != "none":
+        raise ValueError(
+            "The pre-screen only applies to per-series forecasters, batch_ar fits all "
+            "series at once: use --prescreen=none with --forecaster=batch_ar"
+        )
+
+
+def get_detector(args):
+    if args.forecaster not in DETECTORS:
+        raise ValueError(
+            f"Unknown forecaster {args.forecaster}, possibilities: {list(DETECTORS)}"
+        )
+    return DETECTORS[args.forecaster](args)
@@ -0,0 +1,74 @@
+"""
+Store the parsed statistics of a simulation in a single file:
+features for each node and time window
+neighbors for each node and time window
+all DAOs received by the border router
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import trace_schema
+
+# Parsed statistics of all nodes of a simulation
+# features: (node x window x feature) array with columns feature_names
+# neighbors: (node x window x max_nr_neighbors) array of node IDs, padded with 0
+# daos: dataframe with all DAOs received by the border router
+SimulationFeatures = namedtuple(
+    "SimulationFeatures",
+    ["nodes_names", "feature_names", "features", "neighbors", "daos"],
+)
+
+
+def get_store_path(args):
+    return (
+        f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
+        f"simulation-{args.chosen_simulation}.npz"
+    )
+
+
+def save_simulation(args, simulation):
+    path = get_store_path(args)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    # Store every DAO column as its own array, text columns as fixed width strings
+    dao_columns = {
+        f"dao:{column}": (
+            simulation.daos[column].values
+            if pd.api.types.is_numeric_dtype(simulation.daos[column])
+            else np.asarray(simulation.daos[column], dtype=str)
+        )
+        for column in simulation.daos.columns
+    }
+    np.savez(
+        path,
+        nodes_names=np.asarray(simulation.nodes_names, dtype=str),
+        feature_names=np.asarray(simulation.feature_names, dtype=str),
+        features=simulation.features,
+        neighbors=simulation.neighbors,
+        dao_columns=np.asarray(simulation.daos.columns, dtype=str),
+        **dao_columns,
+    )
+
+
+def load_simulation(args):
+    with np.load(get_store_path(args)) as data:
+        daos = trace_schema.apply_schema(
+            pd.DataFrame(
+                {
+                    column: data[f"dao:{column}"]
+                    for column in data["dao_columns"].tolist()
+                }
+            ),
+            trace_schema.DAO_SCHEMA,
+            get_store_path(args),
+        )
+        return SimulationFeatures(
+            nodes_names=data["nodes_names"].tolist(),
+            feature_names=data["feature_names"].tolist(),
+            features=data["features"],
+            neighbors=data["neighbors"],
+            daos=daos,
+        )
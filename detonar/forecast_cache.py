@@ -0,0 +1,72 @@
+"""
+Bounded LRU cache of forecasts, keyed by the hash of the history, the configuration of
+the forecaster and alpha. The cache can be saved to and loaded from a npz file, so that
+repeated runs over the same dataset reuse the forecasts of previous runs.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ForecastCache:
+    """
+    Forecast and interval (forecast, lower, upper) by key, the least recently used
+    forecast is dropped when more than max_size forecasts are cached
+    """
+
+    def __init__(self, max_size, path=None):
+        self.max_size = max_size
+        # np.savez adds the extension if it is missing
+        self.path = path if not path or path.endswith(".npz") else path + ".npz"
+        self.forecasts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.path and os.path.exists(self.path):
+            self.load()
+
+    @staticmethod
+    def key(history, config, alpha):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(np.ascontiguousarray(history, dtype=np.float64).tobytes())
+        digest.update(repr((config, alpha)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key not in self.forecasts:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.forecasts.move_to_end(key)
+        return self.forecasts[key]
+
+    def put(self, key, forecast):
+        self.forecasts[key] = forecast
+        self.forecasts.move_to_end(key)
+        while len(self.forecasts) > self.max_size:
+            self.forecasts.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def load(self):
+        with np.load(self.path) as data:
+            for key, forecast in zip(data["keys"].tolist(), data["forecasts"]):
+                self.put(key, tuple(forecast.tolist()))
+
+    def save(self):
+        if not self.path:
+            return
+        if os.path.dirname(self.path) and not os.path.exists(
+            os.path.dirname(self.path)
+        ):
+            os.makedirs(os.path.dirname(self.path))
+        np.savez(
+            self.path,
+            keys=np.asarray(list(self.forecasts), dtype=str),
+            forecasts=np.asarray(list(self.forecasts.values()), dtype=float).reshape(
+                -1, 3
+            ),
+        )
@@ -0,0 +1,325 @@
+"""
+Online IDS session: the statistics, neighbors and DAOs of each time window are given to
+the session as soon as the window closes, and the alerts of that window are returned.
+The detection of a window is the same as in new_arima_ids, the first lag_val windows
+are only used as history.
+"""
+import io
+import multiprocessing
+import time as tm
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+import detectors
+import new_arima_ids
+import trace_schema
+from attack_class import get_time_step_from_time
+from node_series_store import NodeSeriesStore
+from ring_buffer import RingBuffer
+
+# Alert raised in a time window
+# time: time of the window in seconds, as in the output file of the IDS
+# devices: nodes raising an anomaly, by regressed feature
+# attacks: lines written by the attack classification, e.g. the attack and attacker
+Alert = namedtuple("Alert", ["time", "devices", "attacks"])
+
+# Features regressed to raise anomalies
+FEATURES = ["# DIO rcvd", "# APP rcvd", "# DAO txd"]
+
+
+class DetonarSession:
+    """
+    Detector, DODAG and classification state of the IDS for one network
+    node_names: names of the nodes, in the order of the rows given to step, add_nodes
+        adds the nodes joining later
+    max_latency: seconds after which the series of a window whose detector fit has not
+        finished are checked against the closed-form interval of their history instead,
+        None for no bound. The fits run in a pool of args.ids_workers processes, a fit
+        still running at the bound is not interrupted but its result is dropped, and the
+        classification of a window raising an anomaly is not bounded.
+    output_file: if given, the anomalies and attacks are written in it as in the
+        output file of new_arima_ids
+    The pool of the fits is started with the session, close stops it. Its processes
+    are spawned rather than forked, since the session may be created or stepped in a
+    thread of an asyncio program.
+    """
+
+    def __init__(self, args, node_names, max_latency=None, output_file=None):
+        self.args = args
+        self.node_names = list(node_names)
+        self.max_latency = max_latency
+        self.output_file = output_file
+        self.size = args.lag_val
+        self.feature_names = list(args.attack_classification_features)
+        self._regressed = [self.feature_names.index(feature) for feature in FEATURES]
+        # Window of the last size values of the regressed features
+        self._histories = RingBuffer((len(FEATURES), len(self.node_names)), self.size)
+        # All windows of all features, used by the attack classification, the
+        # capacity is doubled when it is full
+        self._values = np.zeros((len(self.feature_names), len(self.node_names), 64))
+        self._series_dict = self._get_series_dict()
+        self.n_windows = 0
+        self.dios = {node_name: {} for node_name in self.node_names}
+        self._daos = []
+        self.nodes_in_train = None
+        self.detectors_dict = {
+            feature: {node_name: None for node_name in self.node_names}
+            for feature in FEATURES
+        }
+        # Number of series checked against the closed-form interval because of
+        # max_latency
+        self.late_fits = 0
+        # Detectors of the attack classification, by node and feature
+        self.classifier_detectors = {}
+        detectors.check_settings(args)
+        self._executor = ProcessPoolExecutor(
+            max_workers=args.ids_workers or None,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def close(self):
+        # Stop the pool of the detector fits, the session cannot be stepped after it
+        self._executor.shutdown(cancel_futures=True)
+
+    def add_nodes(self, node_names):
+        """
+        Add the nodes joining the network, after the known ones. Their statistics are 0
+        in the earlier windows, and their detectors are fit on the next window.
+        :param node_names: names of nodes, the known ones are skipped
+        """
+        known_nodes = set(self.node_names)
+        new_nodes = [
+            node_name for node_name in node_names if node_name not in known_nodes
+        ]
+        if not new_nodes:
+            return
+        self.node_names.extend(new_nodes)
+        self._values = np.concatenate(
+            [
+                self._values,
+                np.zeros(
+                    (self._values.shape[0], len(new_nodes), self._values.shape[2])
+                ),
+            ],
+            axis=1,
+        )
+        self._series_dict = self._get_series_dict()
+        histories = self._histories.view()
+        self._histories = RingBuffer((len(FEATURES), len(self.node_names)), self.size)
+        self._histories.fill(
+            np.concatenate(
+                [
+                    histories,
+                    np.zeros((len(FEATURES), len(new_nodes), histories.shape[2])),
+                ],
+                axis=1,
+            )
+        )
+        for node_name in new_nodes:
+            # Neighbors are known from the window the node joins
+            self.dios[node_name] = {}
+            for feature in FEATURES:
+                self.detectors_dict[feature][node_name] = None
+
+    def _get_series_dict(self):
+        # Views of the series of all windows by feature and node name
+        return {
+            feature: {
+                node_name: self._values[feature_index, node_index]
+                for node_index, node_name in enumerate(self.node_names)
+            }
+            for feature_index, feature in enumerate(self.feature_names)
+        }
+
+    def _add_window(self, window_features):
+        if self.n_windows == self._values.shape[2]:
+            values = np.zeros(self._values.shape[:2] + (2 * self.n_windows,))
+            values[:, :, : self.n_windows] = self._values
+            self._values = values
+            self._series_dict = self._get_series_dict()
+        self._values[:, :, self.n_windows] = np.asarray(window_features, dtype=float).T
+
+    @property
+    def daos(self):
+        # DAOs received so far, concatenated only when the DODAG is checked
+        if len(self._daos) > 1:
+            self._daos = [pd.concat(self._daos, ignore_index=True)]
+        if not self._daos:
+            return trace_schema.apply_schema(
+                pd.DataFrame(columns=list(trace_schema.DAO_SCHEMA)),
+                trace_schema.DAO_SCHEMA,
+                "DAOs",
+            )
+        return self._daos[0]
+
+    def step(self, window_features, neighbors, new_daos=None):
+        """
+        Add the next time window and check it for anomalies
+        :param window_features: (node x feature) array with columns
+            args.attack_classification_features
+        :param neighbors: (node x max_nr_neighbors) array of the neighbor IDs of each
+            node in the window, padded with 0
+        :param new_daos: dataframe of the DAOs received by the border router in the
+            window, see trace_schema.DAO_SCHEMA
+        :return: list of the alerts of the window
+        """
+        tic = tm.perf_counter()
+        args = self.args
+        window = self.n_windows
+        time_seconds = window * args.time_window + args.time_window
+        self._add_window(window_features)
+        observed = self._values[self._regressed, :, window]
+        # Neighbors are looked up by the time of the anomaly
+        neighbors_dict = new_arima_ids.dios_dict_from_rows(
+            self.node_names, np.asarray(neighbors, dtype=int)[:, None]
+        )
+        for node_name in self.node_names:
+            self.dios[node_name][get_time_step_from_time(time_seconds, args)] = (
+                neighbors_dict[node_name][0]
+            )
+        if new_daos is not None and len(new_daos) > 0:
+            self._daos.append(new_daos)
+        self.n_windows += 1
+
+        alerts = []
+        if window < self.size:
+            # Windows of the first history, the nodes communicating in them are
+            # known once it is complete
+            self._histories.push(observed)
+            if window == self.size - 1:
+                self.nodes_in_train = new_arima_ids.get_nodes_in_train(
+                    NodeSeriesStore(
+                        self.node_names,
+                        self.feature_names,
+                        self._values[:, :, : self.n_windows],
+                    ),
+                    self.size,
+                )
+            return alerts
+
+        histories = self._histories.view()
+        outputs = self._detect(histories, observed, window, time_seconds, tic)
+        self._histories.push(observed)
+
+        list_nodes_raising_anomaly = {feature: [] for feature in FEATURES}
+        for feature_index, feature in enumerate(FEATURES):
+            for node_index, node_name in enumerate(self.node_names):
+                output = outputs[feature_index * len(self.node_names) + node_index]
+                self.detectors_dict[feature][node_name] = output[5]
+                if not output[3] == []:
+                    list_nodes_raising_anomaly[feature].append(output[3])
+        if any(list_nodes_raising_anomaly.values()):
+            report = io.StringIO()
+            new_arima_ids.classify_anomaly(
+                FEATURES,
+                list_nodes_raising_anomaly,
+                list_nodes_raising_anomaly,
+                self.dios,
+                self.daos,
+                self._series_dict,
+                time_seconds,
+                window,
+                self.nodes_in_train,
+                report,
+                args,
+                self.classifier_detectors,
+            )
+            lines = report.getvalue().splitlines()
+            alerts.append(
+                Alert(
+                    time_seconds,
+                    list_nodes_raising_anomaly,
+                    [line.strip() for line in lines[1:]],
+                )
+            )
+            if self.output_file is not None:
+                self.output_file.write(report.getvalue())
+        return alerts
+
+    def _detect(self, histories, observed, window, time_seconds, tic):
+        # One output per feature and node, in the same format as _detector_fit
+        args = self.args
+        alpha = args.alpha
+        series = np.concatenate([histories, observed[:, :, None]], axis=2)
+        if args.forecaster == "batch_ar":
+            return new_arima_ids.batch_ar_fit(
+                series,
+                FEATURES,
+                self.node_names,
+                self.size,
+                0,
+                time_seconds,
+                alpha,
+                args,
+            )
+        escalated, screen_intervals = new_arima_ids.prescreen(
+            series, self.size, 0, args
+        )
+        degenerate, degenerate_forecasts, degenerate_intervals = (
+            detectors.degenerate_intervals(histories, alpha)
+        )
+        degenerate &= escalated
+        fitted = escalated & ~degenerate
+        # Most suspicious series first, so that the bound on the latency drops the
+        # least suspicious ones
+        scores = np.abs(observed - degenerate_forecasts) / (
+            degenerate_intervals[:, :, 1] - degenerate_forecasts
+        )
+        fit_order = sorted(zip(*np.nonzero(fitted)), key=lambda index: -scores[index])
+        fit_outputs = {}
+        if fit_order:
+            futures = {
+                self._executor.submit(
+                    new_arima_ids.detector_check,
+                    histories[feature_index, node_index],
+                    observed[feature_index, node_index],
+                    FEATURES[feature_index],
+                    self.node_names[node_index],
+                    window - self.size,
+                    time_seconds,
+                    alpha,
+                    self.detectors_dict[FEATURES[feature_index]][
+                        self.node_names[node_index]
+                    ],
+                    args,
+                ): (feature_index, node_index)
+                for feature_index, node_index in fit_order
+            }
+            timeout = None
+            if self.max_latency is not None:
+                timeout = max(self.max_latency - (tm.perf_counter() - tic), 0)
+            done, late = wait(futures, timeout=timeout)
+            for future in late:
+                future.cancel()
+            self.late_fits += len(late)
+            for future in done:
+                fit_outputs[futures[future]] = future.result()
+
+        outputs = []
+        for feature_index, feature in enumerate(FEATURES):
+            for node_index, node_name in enumerate(self.node_names):
+                detector = self.detectors_dict[feature][node_name]
+                if (feature_index, node_index) in fit_outputs:
+                    output = fit_outputs[feature_index, node_index]
+                elif (
+                    degenerate[feature_index, node_index]
+                    or fitted[feature_index, node_index]
+                ):
+                    output = new_arima_ids.closed_form_output(
+                        degenerate_forecasts[feature_index, node_index],
+                        degenerate_intervals[feature_index, node_index],
+                        observed[feature_index, node_index],
+                        feature,
+                        node_name,
+                        time_seconds,
+                        detector,
+                    )
+                else:
+                    output = new_arima_ids.screened_output(
+                        screen_intervals[feature_index, node_index], detector
+                    )
+                outputs.append(output)
+        return outputs
@@ -0,0 +1,372 @@
+"""
+Live ingestion of the output of the border router for the online IDS:
+read the rows of the stats and DAO traces from a Cooja serial socket or a TCP stream
+assemble the statistics of each node in each time window, as parse_statistics does
+give each time window to a DetonarSession as soon as it closes
+Each line of the stream is a row of a trace prefixed by the name of the trace, the first
+row of each trace is its header, and rows come in time order:
+stats:SENSOR-6,15000005,0,5,1,3,0,0,384,240,0,0,"[3, 2]"
+dao:21000000,SENSOR-7,SINKNODE-1
+The replay server streams the traces of a simulation of the dataset in this format.
+"""
+import asyncio
+import csv
+import heapq
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import ids_session
+import new_arima_ids
+import parse_statistics
+import settings_parser
+import trace_schema
+
+# Statistics of a closed time window
+# index: index of the window, it holds the rows received in
+#     (index * time_window, (index + 1) * time_window]
+# nodes_names: names of the nodes known when the window closed, in the order of the rows
+# features: (node x feature) array with columns args.attack_classification_features
+# neighbors: (node x max_nr_neighbors) array of neighbor IDs, padded with 0
+# daos: dataframe of the DAOs received up to the end of the window, not in earlier
+#     windows
+ClosedWindow = namedtuple(
+    "ClosedWindow", ["index", "nodes_names", "features", "neighbors", "daos"]
+)
+
+# Traces of the stream
+_TRACES = ("stats", "dao")
+
+
+def _get_time_column(trace, args):
+    # Column with the time of the rows of a trace, as read by parse_statistics
+    return args.time_feat_micro if trace == "stats" else "TIME"
+
+
+class WindowAssembler:
+    """
+    Statistics of the open time window, closed when a row of a later window arrives.
+    The nodes are nodes_names, by default the nodes sending in the first window, followed
+    by the nodes joining later in the order of their first window. A joining node has no
+    statistics and no neighbors in the windows before it joined. Rows after
+    simulation_time are dropped. Nodes without rows in a window keep the features and
+    neighbors of their previous window, as in parse_statistics.
+    """
+
+    def __init__(self, args, nodes_names=None):
+        self.args = args
+        self.nodes_names = list(nodes_names) if nodes_names is not None else None
+        # Use attack classification features except "changed parent" which is computed
+        # from DAOs
+        self.feature_list = args.attack_classification_features[:-1]
+        self.headers = {}
+        # Index of the open window and its stats rows, the windows after
+        # simulation_time are not opened
+        self.window = 0
+        self.n_windows = parse_statistics.get_nr_windows(args)
+        self._stats_rows = []
+        # DAOs not given with a closed window yet
+        self._dao_rows = []
+        # Nodes changing parent by window, and last parent of each node
+        self._changed_parent = {}
+        self._last_parent = {}
+        # Features and neighbors of the last closed window
+        self._previous = None
+        self.dropped_rows = 0
+
+    def add_line(self, line):
+        """
+        Add a line of the stream
+        :return: list of the ClosedWindow closed by the line
+        """
+        trace, _, row = line.partition(":")
+        if trace not in _TRACES or not row:
+            self.dropped_rows += 1
+            return []
+        values = next(csv.reader([row]))
+        if trace not in self.headers:
+            self.headers[trace] = values
+            return []
+        time = int(
+            values[self.headers[trace].index(_get_time_column(trace, self.args))]
+        )
+        window = int(parse_statistics.get_window_index(time, self.args))
+        closed = self._close_until(min(window, self.n_windows))
+        if window >= self.n_windows:
+            # Rows after the simulation time are dropped, as in parse_statistics
+            self.dropped_rows += 1
+        elif trace == "dao":
+            self._add_dao(values, time)
+        elif window < self.window:
+            # Rows of a closed window are late
+            self.dropped_rows += 1
+        else:
+            self._stats_rows.append(values)
+        return closed
+
+    def flush(self):
+        # Close the open window at the end of the stream
+        if self.window >= self.n_windows or (
+            not self._stats_rows and not self._dao_rows
+        ):
+            return []
+        return self._close_until(self.window + 1)
+
+    def _add_dao(self, values, time):
+        row = dict(zip(self.headers["dao"], values))
+        self._dao_rows.append(values)
+        # A node changed parent when its DAO has another parent than its previous DAO
+        # (the first DAO of each node always counts as a change)
+        source = row["SOURCE_ID"]
+        if self._last_parent.get(source) != row["PARENT_ID"]:
+            self._changed_parent.setdefault(
+                int(time / 1e6 / self.args.time_window), set()
+            ).add(source)
+        self._last_parent[source] = row["PARENT_ID"]
+
+    def _close_until(self, window):
+        closed = []
+        while self.window < window:
+            closed.append(self._close())
+            self.window += 1
+        return closed
+
+    def _get_stats(self):
+        columns = self.headers.get("stats", list(trace_schema.STATS_SCHEMA))
+        return trace_schema.apply_schema(
+            pd.DataFrame(self._stats_rows, columns=columns),
+            trace_schema.STATS_SCHEMA,
+            "stats stream",
+        )
+
+    def _get_daos(self):
+        # DAOs received up to the end of the open window
+        end_time = (self.window + 1) * self.args.time_window * 1e6
+        columns = self.headers.get("dao", list(trace_schema.DAO_SCHEMA))
+        daos = trace_schema.apply_schema(
+            pd.DataFrame(self._dao_rows, columns=columns),
+            trace_schema.DAO_SCHEMA,
+            "DAO stream",
+        )
+        is_closed = daos["TIME"].values <= end_time
+        self._dao_rows = [
+            row for row, closed in zip(self._dao_rows, is_closed) if not closed
+        ]
+        return daos[is_closed].reset_index(drop=True)
+
+    def _close(self):
+        stats = self._get_stats()
+        self._stats_rows = []
+        if self.nodes_names is None:
+            self.nodes_names = []
+        known_nodes = len(self.nodes_names)
+        self.nodes_names.extend(
+            node
+            for node in parse_statistics.get_unique_nodes_names(stats)
+            if node not in self.nodes_names
+        )
+        node_index = {node: index for index, node in enumerate(self.nodes_names)}
+        if self._previous is None:
+            self._previous = np.zeros((0, len(self.feature_list))), []
+        # Nodes joining in this window have no statistics before it
+        features = np.vstack(
+            [
+                self._previous[0],
+                np.zeros((len(self.nodes_names) - known_nodes, len(self.feature_list))),
+            ]
+        )
+        neighbors = list(self._previous[1]) + [
+            [] for _ in self.nodes_names[known_nodes:]
+        ]
+        for node, node_stats in stats.groupby("SENDER_ID", sort=False, observed=True):
+            if node not in node_index:
+                self.dropped_rows += len(node_stats)
+                continue
+            (
+                features[node_index[node]],
+                neighbors[node_index[node]],
+            ) = parse_statistics.parse_stats_timewindow(node_stats, self.feature_list)
+        self._previous = features, neighbors
+        changed_parent = self._changed_parent.pop(self.window, set())
+        return ClosedWindow(
+            self.window,
+            list(self.nodes_names),
+            np.column_stack(
+                [
+                    features,
+                    [int(node in changed_parent) for node in self.nodes_names],
+                ]
+            ),
+            parse_statistics.get_neighbor_rows(self.args, neighbors),
+            self._get_daos(),
+        )
+
+
+async def read_windows(reader, assembler, queue):
+    """
+    Assemble the time windows of the stream. When the queue is full the stream is not
+    read until the IDS takes a window, so that the sender is slowed down by TCP flow
+    control instead of the windows piling up in memory.
+    A None is put in the queue at the end of the stream.
+    """
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        for window in assembler.add_line(line.decode("utf8").rstrip("\r\n")):
+            await queue.put(window)
+    for window in assembler.flush():
+        await queue.put(window)
+    await queue.put(None)
+
+
+async def run_session(queue, args, output_file=None):
+    """
+    Give each closed window to the IDS, the session is created with the nodes of the
+    first window and the nodes joining later are added to it. The IDS runs in a thread,
+    so that the stream is read meanwhile. The series whose fit did not finish within
+    live_max_latency are reported for each window.
+    :return: the session, None if the stream had no window
+    """
+    loop = asyncio.get_running_loop()
+    session = None
+    try:
+        while True:
+            window = await queue.get()
+            if window is None:
+                return session
+            if session is None:
+                session = ids_session.DetonarSession(
+                    args,
+                    window.nodes_names,
+                    max_latency=args.live_max_latency or None,
+                    output_file=output_file,
+                )
+            session.add_nodes(window.nodes_names)
+            late_fits = session.late_fits
+            alerts = await loop.run_in_executor(
+                None, session.step, window.features, window.neighbors, window.daos
+            )
+            if session.late_fits > late_fits:
+                print(
+                    f"Window {window.index}: {session.late_fits - late_fits} series "
+                    "checked against the closed-form interval of their history, their "
+                    "fit did not finish within live_max_latency"
+                )
+            for alert in alerts:
+                print(f"Alert at time {alert.time}: {alert.devices} {alert.attacks}")
+    finally:
+        if session is not None:
+            session.close()
+
+
+async def ingest(args, output_file=None):
+    # Read the stream at live_host:live_port and run the IDS on it until it ends
+    reader, writer = await asyncio.open_connection(args.live_host, args.live_port)
+    assembler = WindowAssembler(args)
+    queue = asyncio.Queue(maxsize=args.live_queue_size)
+    try:
+        _, session = await asyncio.gather(
+            read_windows(reader, assembler, queue),
+            run_session(queue, args, output_file),
+        )
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    if assembler.dropped_rows:
+        print(
+            f"Dropped {assembler.dropped_rows} rows of senders that are not nodes, late "
+            "rows or rows after the simulation time"
+        )
+    if session is not None and session.late_fits:
+        print(
+            f"{session.late_fits} series checked against the closed-form interval of "
+            "their history in total, raise live_max_latency or ids_workers to fit them"
+        )
+    return session
+
+
+def _read_trace(path, trace, args):
+    # (time, line) of each row of a trace, the header first
+    with open(path, encoding="utf8") as trace_file:
+        header = trace_file.readline().rstrip("\r\n")
+        time_index = next(csv.reader([header])).index(_get_time_column(trace, args))
+        yield -np.inf, f"{trace}:{header}"
+        for line in trace_file:
+            line = line.rstrip("\r\n")
+            if line:
+                yield int(next(csv.reader([line]))[time_index]), f"{trace}:{line}"
+
+
+async def _replay(args, writer):
+    # Stream the stats and DAO traces of the chosen simulation merged in time order
+    last_time = None
+    try:
+        for time, line in heapq.merge(
+            _read_trace(parse_statistics.get_trace_path(args, "dao"), "dao", args),
+            _read_trace(parse_statistics.get_trace_path(args, "stats"), "stats", args),
+            key=lambda row: row[0],
+        ):
+            if args.live_replay_speed > 0 and np.isfinite(time):
+                if last_time is not None:
+                    await asyncio.sleep(
+                        (time - last_time) / 1e6 / args.live_replay_speed
+                    )
+                last_time = time
+            writer.write(f"{line}\n".encode("utf8"))
+            # Wait while the reader does not keep up
+            await writer.drain()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def start_replay_server(args):
+    return await asyncio.start_server(
+        lambda _, writer: _replay(args, writer), args.live_host, args.live_port
+    )
+
+
+async def _main(args):
+    if args.live_replay not in ("none", "serve", "local"):
+        raise ValueError(
+            f"Unknown live_replay {args.live_replay}, possibilities: none, serve, local"
+        )
+    server = None
+    if args.live_replay in ("serve", "local"):
+        server = await start_replay_server(args)
+        print(f"Replaying simulation {args.chosen_simulation} of {args.scenario}")
+    if args.live_replay == "serve":
+        async with server:
+            await server.serve_forever()
+    try:
+        with open(
+            new_arima_ids.get_output_filename(args), "w", encoding="utf8"
+        ) as output_file:
+            output_file.write(
+                f"Scenario: {args.scenario} - "
+                f"Simulation {args.chosen_simulation.split('-')[-1]}\n"
+            )
+            await ingest(args, output_file)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+
+def main():
+    args = settings_parser.arg_parse()
+    try:
+        asyncio.run(_main(args))
+    except ConnectionError as error:
+        print(
+            f"Cannot read the stream at {args.live_host}:{args.live_port}: {error}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
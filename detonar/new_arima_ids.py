@@ -1,19 +1,42 @@
+import argparse
 import glob
 import os
 import random
+import sys
 import time as tm
+import traceback
 import warnings
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 import pandas as pd
-import pmdarima as pm
 from joblib import Parallel, delayed
 
 warnings.filterwarnings("ignore")
 
+import batch_ar
+import detectors
+import feature_store
+import forecast_cache
+import node_series_store
 import settings_parser
+import trace_schema
 from reconstruct_dodag import extract_dodag_before_after
-from attack_class import extract_neighborhood, classify_attack_from_dodag
+from attack_class import (
+    extract_neighborhood,
+    classify_attack_from_dodag,
+)
+
+# Shared memory blocks of the series attached by this process, by name
+_SHARED_SERIES = {}
+
+# Inputs of the IDS for one simulation
+# store: NodeSeriesStore with the statistics of all nodes
+# dios: neighbors of each node by time, see dios_dict_from_rows
+# daos: dataframe with all DAOs received by the border router
+SimulationInputs = namedtuple("SimulationInputs", ["store", "dios", "daos"])
 
 
 # Read csv file not using first column as index
@@ -35,65 +58,64 @@ def _get_files(filenames):
     return all_files_list
 
 
-def _get_series(file, feature):
-    data = pd.read_csv(file)
-    return data[feature]
-
-
-def _get_row_list(file, index):
-    data = pd.read_csv(file)
-    return data.iloc[index]
-
-
 def _get_node_name_from_id(node_id):
     if node_id == 1:
         return "SINKNODE-1"
     return f"SENSOR-{int(node_id)}"
 
 
-def _all_series_dict(all_files_list, args):
-    # Extract nodes names for dictionary of features series
-    node_names = [file.split("/")[-1].split("_")[0] for file in all_files_list]
-    # Build dictionary to use for feature series of each node
-    series_dict = {
-        feature: {node_name: [] for node_name in node_names}
-        for feature in args.attack_classification_features
-    }
-    # For each node get all the feature series and put it in the corresponding dictionary entry
-    for file in all_files_list:
-        node_name = file.split("/")[-1].split("_")[0]
-        for feature in args.attack_classification_features:
-            series = _get_series(file, feature)
-            series_dict[feature][node_name] = series
-    return series_dict
+def _load_neighbor_rows(files, args):
+    """
+    Load the neighbor files of all nodes, each file is parsed once
+    :return: node names and (node x window x max_nr_neighbors) array of neighbor IDs,
+        padded with 0
+    """
+    node_names = [file.split("/")[-1].split("_")[0] for file in files]
+    total_timesteps = int(args.simulation_time / args.time_window)
+    all_rows = [pd.read_csv(file).values[:total_timesteps] for file in files]
+    neighbor_rows = np.zeros(
+        (len(files), total_timesteps, max(rows.shape[1] for rows in all_rows)),
+        dtype=int,
+    )
+    for node_index, rows in enumerate(all_rows):
+        neighbor_rows[node_index, : rows.shape[0], : rows.shape[1]] = rows
+    return node_names, neighbor_rows
 
 
 def _all_dios_dict(files, args):
-    # Extract nodes names for dictionary of features series
-    node_names = [file.split("/")[-1].split("_")[0] for file in files]
-    total_timesteps = int(args.simulation_time / args.time_window)
-    # Build dictionary where first entry is the node, and
-    dios_dict = {
-        node_name: {time_step: [] for time_step in range(total_timesteps)}
-        for node_name in node_names
+    # Neighbors of each node and time step from the neighbor files
+    node_names, neighbor_rows = _load_neighbor_rows(files, args)
+    return dios_dict_from_rows(node_names, neighbor_rows)
+
+
+def dios_dict_from_rows(node_names, neighbor_rows):
+    # Build dictionary where first entry is the node, and second the time step, from a
+    # (node x window x max_nr_neighbors) array
+    # Names of all node IDs, ID 0 pads the rows
+    id_names = [""] + [
+        _get_node_name_from_id(node_id)
+        for node_id in range(1, int(neighbor_rows.max(initial=0)) + 1)
+    ]
+    # Neighbors of a row are the IDs before the first 0
+    is_padding = neighbor_rows == 0
+    lengths = np.where(
+        is_padding.any(axis=2), is_padding.argmax(axis=2), neighbor_rows.shape[2]
+    )
+    return {
+        node_name: {
+            time_step: [
+                id_names[node_id]
+                for node_id in neighbor_rows[node_index, time_step, :length].tolist()
+            ]
+            for time_step, length in enumerate(lengths[node_index].tolist())
+        }
+        for node_index, node_name in enumerate(node_names)
     }
-    # For each node get all the featrue series and put it in the corresponding dictionary entry
-    for file in files:
-        node_name = file.split("/")[-1].split("_")[0]
-        for time_step in range(total_timesteps):
-            row = _get_row_list(file, time_step)
-            series = []
-            for node_id in row:
-                if node_id == 0:
-                    break
-                series.append(_get_node_name_from_id(node_id))
-            dios_dict[node_name][time_step] = series
-    return dios_dict
-
-
-def _create_trains_and_tests(all_files_list, features, size):
+
+
+def _create_trains_and_tests(store, features, size):
     # Get node names
-    node_names = [file.split("/")[-1].split("_")[0] for file in all_files_list]
+    node_names = store.node_names
     # Create empty dictionaries for trains,tests and predictions for each feature and each node
     trains_dict = {
         feature: {node_name: [] for node_name in node_names} for feature in features
@@ -110,14 +132,12 @@ def _create_trains_and_tests(all_files_list, features, size):
     conf_intervals_dict = {
         feature: {node_name: [] for node_name in node_names} for feature in features
     }
-    # For each file fill the corresponding dictionary entry
-    for file in all_files_list:
-        node_name = file.split("/")[-1].split("_")[0]
+    # For each node fill the corresponding dictionary entry
+    for node_name in node_names:
         # Get time series of the chosen feature
         for feature in features:
-            series = _get_series(file, feature)
-            X = np.squeeze(series.values)
-            # Split into first train and remaining test
+            X = store.series(feature, node_name)
+            # Split into first train and remaining test, views of the stored series
             train, test = X[0:size], X[size : len(X)]
             # Append train and test to the list of all trains and tests
             trains_dict[feature][node_name] = train
@@ -135,19 +155,56 @@ def _create_trains_and_tests(all_files_list, features, size):
     )
 
 
-def _get_nodes_in_train(nodes_stats, node_names, train_size):
-    list_nodes = []
+@contextmanager
+def _shared_series(store, features):
+    """
+    Copy the series of the regressed features of all nodes into shared memory, so that
+    ARIMA workers read them without pickling
+    :return: name and shape of the (feature x node x time) array in shared memory
+    """
+    shape = (len(features), len(store.node_names), store.n_windows)
+    block = shared_memory.SharedMemory(
+        create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize
+    )
+    try:
+        series = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        series[:] = store.features(features)
+        _SHARED_SERIES[block.name] = (block, series)
+        del series
+        yield block.name, shape
+    finally:
+        _SHARED_SERIES.pop(block.name, None)
+        block.close()
+        block.unlink()
+
+
+def _get_shared_series(shared_series):
+    # Attach to the shared series once per worker process
+    name, shape = shared_series
+    if name not in _SHARED_SERIES:
+        # Workers are kept between simulations, the series of the earlier ones are not
+        # read anymore
+        for other_name in list(_SHARED_SERIES):
+            _SHARED_SERIES.pop(other_name)[0].close()
+        block = shared_memory.SharedMemory(name=name)
+        # The block is unlinked by the process that created it, not by the worker
+        resource_tracker.unregister(block._name, "shared_memory")
+        _SHARED_SERIES[name] = (
+            block,
+            np.ndarray(shape, dtype=np.float64, buffer=block.buf),
+        )
+    return _SHARED_SERIES[name][1]
+
+
+def get_nodes_in_train(store, train_size):
     # Get all nodes that transmitted at least one packet during training
-    for node_id in node_names:
-        train = nodes_stats[node_id].head(train_size)
-        if (
-            train["# DIO txd"].sum()
-            + train["# DIS txd"].sum()
-            + train["# DAO txd"].sum()
-            + train["# APP txd"].sum()
-            > 0
-        ):
-            list_nodes.append(node_id)
+    txd_features = ["# DIO txd", "# DIS txd", "# DAO txd", "# APP txd"]
+    transmitted = store.features(txd_features)[:, :, :train_size].sum(axis=(0, 2))
+    list_nodes = [
+        node_id
+        for node_id, node_transmitted in zip(store.node_names, transmitted)
+        if node_transmitted > 0
+    ]
     print(f"list_nodes in train: {list_nodes}")
     return list_nodes
 
@@ -192,10 +249,8 @@ def _extract_nodes_dests(original_net_traffic, size, args):
 
     return dict_nodes_dests
 
-def main():
-    tic_main = tm.perf_counter()
-    args = settings_parser.arg_parse()
 
+def get_output_filename(args):
     # Setting file name for output txt
     if not os.path.exists(
         os.path.join(
@@ -223,46 +278,119 @@ def main():
         str(int(args.simulation_time)),
         args.chosen_simulation.split("-")[-1] + ".txt",
     )
-    output_file = open(output_filename, "w", encoding="utf8")
-    output_file.write(
-        f"Scenario: {args.scenario} - Simulation {args.chosen_simulation.split('-')[-1]}\n"
-    )
-    # Getting data path
-    filenames = glob.glob(
-        os.path.join(
-            os.getcwd(),
-            args.feat_folders,
-            args.scenario,
-            str(int(args.simulation_time)),
-            "*",
+    return output_filename
+
+
+def load_simulation(args):
+    """
+    Load the statistics, neighbors and DAOs of the simulation chosen in args
+    :return: SimulationInputs
+    """
+    if args.feature_store == "npz":
+        # Get statistics, neighbors and DAOs of all nodes from the simulation store
+        simulation = feature_store.load_simulation(args)
+        daos = simulation.daos
+        dios = dios_dict_from_rows(simulation.nodes_names, simulation.neighbors)
+        store = node_series_store.NodeSeriesStore.from_simulation(simulation)
+    else:
+        # Getting data path
+        filenames = glob.glob(
+            os.path.join(
+                os.getcwd(),
+                args.feat_folders,
+                args.scenario,
+                str(int(args.simulation_time)),
+                "*",
+            )
         )
-    )
-    filenames.sort()
-    all_files = _get_files(filenames)
-    all_files = [item for item in all_files if args.chosen_simulation in item]
-    # Get DAOs
-    dao_file = [item for item in all_files if "DAO" in item]
-    daos = pd.read_csv(dao_file[0])
-    # Pick file containing DIOs
-    dio_files = [item for item in all_files if "neighbor" in item]
-    dios = _all_dios_dict(dio_files, args)
-
-    # Remove file containing DAOs and neighbors
-    all_files = [
-        item
-        for item in all_files
-        if ("SENSOR" in item or "SINKNODE") and "stats" in item
-    ]
-    all_series_attack_classification = _all_series_dict(all_files, args)
+        filenames.sort()
+        all_files = _get_files(filenames)
+        all_files = [item for item in all_files if args.chosen_simulation in item]
+        # Get DAOs
+        dao_file = [item for item in all_files if "DAO" in item]
+        daos = trace_schema.read_daos(dao_file[0])
+        # Pick file containing DIOs
+        dio_files = [item for item in all_files if "neighbor" in item]
+        dios = _all_dios_dict(dio_files, args)
+
+        # Remove file containing DAOs and neighbors
+        all_files = [
+            item
+            for item in all_files
+            if ("SENSOR" in item or "SINKNODE") and "stats" in item
+        ]
+
+        # Read the time series of statistics of each node once
+        store = node_series_store.NodeSeriesStore.from_csv(all_files)
+    return SimulationInputs(store, dios, daos)
+
+
+def run_simulation(args, inputs=None, parallel=None):
+    """
+    Run the IDS on the simulation chosen in args and write its output file
+    :param inputs: SimulationInputs of the simulation, loaded from args if None
+    :param parallel: joblib Parallel fitting the detectors, kept open by the caller to
+        share its workers between simulations, a new one is started if None
+    """
+    if parallel is None:
+        with Parallel(n_jobs=_get_n_jobs(args)) as parallel:
+            return run_simulation(args, inputs, parallel)
+    with open(get_output_filename(args), "w", encoding="utf8") as output_file:
+        output_file.write(
+            f"Scenario: {args.scenario} - "
+            f"Simulation {args.chosen_simulation.split('-')[-1]}\n"
+        )
+        if inputs is None:
+            inputs = load_simulation(args)
+        _run_ids(args, inputs, parallel, output_file)
+
+
+def run_batch(jobs, args):
+    """
+    Run the IDS on each (scenario, simulation) job in this process, all simulations
+    share the same workers
+    :return: list of (scenario, simulation, traceback) for the simulations that failed
+    """
+    failures = []
+    with Parallel(n_jobs=_get_n_jobs(args)) as parallel:
+        for scenario, simulation in jobs:
+            sim_args = argparse.Namespace(**vars(args))
+            sim_args.scenario = scenario
+            sim_args.chosen_simulation = simulation
+            print(f"Running IDS on scenario: {scenario} simulation: {simulation}")
+            try:
+                run_simulation(sim_args, parallel=parallel)
+            except Exception:  # pylint: disable=broad-except
+                error = traceback.format_exc()
+                print(
+                    f"IDS failed for scenario: {scenario} simulation: {simulation}\n"
+                    f"{error}",
+                    file=sys.stderr,
+                )
+                failures.append((scenario, simulation, error))
+    print(f"Ran IDS on {len(jobs) - len(failures)}/{len(jobs)} simulations")
+    return failures
 
-    # Create node_stats with columns node_id and time series of statistics for each node
-    nodes_stats = {}
-    node_names = []
-    for file in all_files:
-        node_id = file.split("/")[-1].split("_")[0]
-        node_names.append(node_id)
-        stats = pd.read_csv(file)
-        nodes_stats[node_id] = stats
+
+def _get_n_jobs(args):
+    return args.ids_workers if args.ids_workers > 0 else -1
+
+
+def _parse_jobs(jobs):
+    # "scenario/simulation,scenario/simulation" -> [(scenario, simulation), ...]
+    return [tuple(job.strip().split("/")) for job in jobs.split(",") if job.strip()]
+
+
+def _run_ids(args, inputs, parallel, output_file):
+    store, dios, daos = inputs
+    node_names = store.node_names
+    # Forecasts by path are counted for each simulation
+    detectors.path_counts.clear()
+    # Detectors of the attack classification, by node and feature
+    classifier_detectors = {}
+    all_series_attack_classification = store.series_dict(
+        args.attack_classification_features
+    )
 
     # Select feature to be regressed
     feature = args.feature_for_anomalies
@@ -272,217 +400,400 @@ def main():
     alpha = args.alpha
 
     # Extract lists containing series for each device
-    trains, tests, histories, predictions, conf_intervals = _create_trains_and_tests(
-        all_files, features, size
-    )
-    list_communicating_nodes_from_train = _get_nodes_in_train(
-        nodes_stats, node_names, size
+    trains, tests, _, predictions, conf_intervals = _create_trains_and_tests(
+        store, features, size
     )
+    list_communicating_nodes_from_train = get_nodes_in_train(store, size)
     # list_communicating_nodes_from_train = extract_list_nodes(original_net_traffic, size, args)
     # dict_nodes_dests_from_train = extract_nodes_dests(original_net_traffic, size, args)
-    node_names = [file.split("/")[-1].split("_")[0] for file in all_files]
     # List to be filled with time performances
     list_pred_times = []
+    # Detector of each node and feature, fitted on the first history and updated with
+    # each new observation, unsupported settings fail here rather than in the workers
+    detectors.check_settings(args)
+    # Number of detector fits avoided by the pre-screen
+    avoided_fits = 0
+    # Forecasts of earlier histories, only for detectors whose forecasts depend on the
+    # history alone
+    config = detectors.get_config(args)
+    forecasts = (
+        forecast_cache.ForecastCache(args.forecast_cache_size, args.forecast_cache_file)
+        if args.forecast_cache_size > 0 and config is not None
+        else None
+    )
+    detectors_dict = {
+        feature: {node_name: None for node_name in node_names} for feature in features
+    }
 
     # Get length of train and test series and number of nodes
     test_length = len(tests[features[0]][node_names[0]])
     train_length = len(trains[features[0]][node_names[0]])
     n_nodes = len(node_names)
 
-    # Through the length of test compute predictions in parallel
-    for time_step in range(test_length):
-        # Compute corresponding time in seconds to know when each anomaly is raised
-        time_seconds = (time_step + train_length) * args.time_window + args.time_window
-        # Define list of nodes that will be checked by attack classifier
-        list_nodes_raising_anomaly = {feature: [] for feature in features}
-        list_nodes_raising_anomaly_full_name = {feature: [] for feature in features}
-        bool_raise_anomaly = False
-        tic_arima = tm.perf_counter()
-        for feature in features:
+    # Through the length of test compute predictions in parallel, the workers are started
+    # once and kept for all time steps
+    # History of each prediction is the window of size time steps before it, read by the
+    # workers from the series in shared memory
+    with _shared_series(store, features) as shared_series:
+        for time_step in range(test_length):
+            # Compute corresponding time in seconds to know when each anomaly is raised
+            time_seconds = (
+                time_step + train_length
+            ) * args.time_window + args.time_window
+            # Define list of nodes that will be checked by attack classifier
+            list_nodes_raising_anomaly = {feature: [] for feature in features}
+            list_nodes_raising_anomaly_full_name = {feature: [] for feature in features}
+            bool_raise_anomaly = False
+            tic_arima = tm.perf_counter()
             print(
-                f"\rARIMA on time_step: {time_seconds}/"
-                f"{args.simulation_time} and feature: {feature}",
+                f"\rARIMA on time_step: {time_seconds}/{args.simulation_time}",
                 end="\r",
             )
             if time_step == test_length - 1:
                 print()
-            # For each considered device compute forecast using arima and check for  anomaly
-            # parallelization
-            with Parallel(n_jobs=12) as parallel:
-                output_parallelization = parallel(
-                    delayed(_arima_fit)(
-                        histories,
-                        feature,
-                        node_index,
-                        all_files,
-                        tests,
-                        time_step,
-                        time_seconds,
-                        alpha,
-                    )
-                    for node_index in range(n_nodes)
-                )
-
-            for node_index in range(n_nodes):
-                node_name = all_files[node_index].split("/")[-1].split("_")[0]
-                # Set history of this node for next prediction
-                obs = tests[feature][node_name][time_step]
-                histories[feature][node_name] = np.append(
-                    histories[feature][node_name], obs
-                )
-                histories[feature][node_name] = histories[feature][node_name][1:]
-
-                list_pred_times.append(output_parallelization[node_index][0])
-                predictions[feature][node_name].append(
-                    output_parallelization[node_index][1]
-                )
-                conf_intervals[feature][node_name].append(
-                    output_parallelization[node_index][2]
+            if args.forecaster == "batch_ar":
+                # Fit AR models of all nodes of each feature at once in this process
+                output_parallelization = batch_ar_fit(
+                    _get_shared_series(shared_series),
+                    features,
+                    node_names,
+                    size,
+                    time_step,
+                    time_seconds,
+                    alpha,
+                    args,
                 )
-                if not output_parallelization[node_index][3] == []:
-                    list_nodes_raising_anomaly[feature].append(
-                        output_parallelization[node_index][3]
+            else:
+                series = _get_shared_series(shared_series)
+                # Only the series whose observation fails the pre-screen are checked by
+                # the detectors
+                escalated, screen_intervals = prescreen(series, size, time_step, args)
+                if args.prescreen != "none":
+                    window_avoided_fits = escalated.size - np.count_nonzero(escalated)
+                    avoided_fits += window_avoided_fits
+                    print(
+                        f"Pre-screen avoided {window_avoided_fits}/{escalated.size} "
+                        f"fits at time {time_seconds}"
+                    )
+                # Constant and near constant histories get a closed-form interval
+                degenerate, degenerate_forecasts, degenerate_intervals = (
+                    detectors.degenerate_intervals(
+                        series[:, :, time_step : time_step + size], alpha
                     )
-                    list_nodes_raising_anomaly_full_name[feature].append(
-                        output_parallelization[node_index][4]
+                )
+                degenerate &= escalated
+                fitted = escalated & ~degenerate
+                # Histories already forecast are taken from the cache
+                cache_keys = {}
+                cached_forecasts = {}
+                if forecasts is not None:
+                    for feature_index, node_index in zip(*np.nonzero(fitted)):
+                        key = forecasts.key(
+                            series[
+                                feature_index, node_index, time_step : time_step + size
+                            ],
+                            config,
+                            alpha,
+                        )
+                        cached = forecasts.get(key)
+                        if cached is None:
+                            cache_keys[feature_index, node_index] = key
+                        else:
+                            cached_forecasts[feature_index, node_index] = cached
+                            fitted[feature_index, node_index] = False
+                detectors.path_counts["degenerate"] += int(np.count_nonzero(degenerate))
+                detectors.path_counts["cached"] += len(cached_forecasts)
+                detectors.path_counts["detector"] += int(np.count_nonzero(fitted))
+                # For each considered device and feature compute forecast using arima and
+                # check for anomaly, all fits of the time step are given to the workers as
+                # one batch
+                fits = iter(
+                    parallel(
+                        delayed(_detector_fit)(
+                            shared_series,
+                            feature,
+                            feature_index,
+                            node_name,
+                            node_index,
+                            size,
+                            time_step,
+                            time_seconds,
+                            alpha,
+                            detectors_dict[feature][node_name],
+                            args,
+                        )
+                        for feature_index, feature in enumerate(features)
+                        for node_index, node_name in enumerate(node_names)
+                        if fitted[feature_index, node_index]
                     )
-            if not (
+                )
+                output_parallelization = []
+                for feature_index, feature in enumerate(features):
+                    for node_index, node_name in enumerate(node_names):
+                        if fitted[feature_index, node_index]:
+                            output = next(fits)
+                            if (feature_index, node_index) in cache_keys:
+                                forecasts.put(
+                                    cache_keys[feature_index, node_index],
+                                    (
+                                        float(np.ravel(output[1])[0]),
+                                        float(output[2][0][0]),
+                                        float(output[2][0][1]),
+                                    ),
+                                )
+                        elif (feature_index, node_index) in cached_forecasts:
+                            forecast, lower, upper = cached_forecasts[
+                                feature_index, node_index
+                            ]
+                            output = closed_form_output(
+                                forecast,
+                                np.array([lower, upper]),
+                                series[feature_index, node_index, time_step + size],
+                                feature,
+                                node_name,
+                                time_seconds,
+                                detectors_dict[feature][node_name],
+                            )
+                        elif degenerate[feature_index, node_index]:
+                            output = closed_form_output(
+                                degenerate_forecasts[feature_index, node_index],
+                                degenerate_intervals[feature_index, node_index],
+                                series[feature_index, node_index, time_step + size],
+                                feature,
+                                node_name,
+                                time_seconds,
+                                detectors_dict[feature][node_name],
+                            )
+                        else:
+                            output = screened_output(
+                                screen_intervals[feature_index, node_index],
+                                detectors_dict[feature][node_name],
+                            )
+                        output_parallelization.append(output)
+            for feature_index, feature in enumerate(features):
+                for node_index in range(n_nodes):
+                    node_name = node_names[node_index]
+                    output = output_parallelization[
+                        feature_index * n_nodes + node_index
+                    ]
+                    detectors_dict[feature][node_name] = output[5]
+                    list_pred_times.append(output[0])
+                    predictions[feature][node_name].append(output[1])
+                    conf_intervals[feature][node_name].append(output[2])
+                    if not output[3] == []:
+                        list_nodes_raising_anomaly[feature].append(output[3])
+                        list_nodes_raising_anomaly_full_name[feature].append(output[4])
+            bool_raise_anomaly = not (
                 list_nodes_raising_anomaly
                 == {"# DIO rcvd": [], "# APP rcvd": [], "# DAO txd": []}
-            ):
-                bool_raise_anomaly = True
-            else:
-                bool_raise_anomaly = False
-        toc_arima = tm.perf_counter()
-        # If anomaly is raised get neighborhood, check dodag and get features for classification
-        if bool_raise_anomaly:
-            neighborhoods_dict = {feature: [] for feature in features}
-            neighborhoods_full_name_dict = {feature: [] for feature in features}
-            nodes_to_check_dict = {feature: [] for feature in features}
-            nodes_to_check_full_name_dict = {feature: [] for feature in features}
-
-            for feature in features:
-                (
-                    neighborhoods_full_name_dict[feature],
-                    neighborhoods_dict[feature],
-                ) = extract_neighborhood(
+            )
+            toc_arima = tm.perf_counter()
+            # If anomaly is raised get neighborhood, check dodag and get features for classification
+            if bool_raise_anomaly:
+                classify_anomaly(
+                    features,
+                    list_nodes_raising_anomaly,
+                    list_nodes_raising_anomaly_full_name,
                     dios,
-                    list_nodes_raising_anomaly_full_name[feature],
+                    daos,
+                    all_series_attack_classification,
                     time_seconds,
+                    time_step + train_length,
+                    list_communicating_nodes_from_train,
+                    output_file,
                     args,
+                    classifier_detectors,
                 )
-                # Nodes to check are the ones that have raised anomalies and their neighbours
-                nodes_to_check_dict[feature] = (
-                    list_nodes_raising_anomaly[feature] + neighborhoods_dict[feature]
-                )
-                nodes_to_check_full_name_dict[feature] = (
-                    list_nodes_raising_anomaly_full_name[feature]
-                    + neighborhoods_full_name_dict[feature]
-                )
-            # Extract single list containing all nodes that raised an anomaly in either feature
-            single_list_nodes_raising_anomaly = [
-                node
-                for feature_anom in features
-                for node in list_nodes_raising_anomaly[feature_anom]
-            ]
-            single_list_nodes_raising_anomaly = list(
-                set(single_list_nodes_raising_anomaly)
-            )
-            # Print anomaly and nodes involved in the output file
-            output_file.write(
-                f"Anomaly raised at time {time_seconds}. "
-                f"Devices involved: {list_nodes_raising_anomaly}\n"
-            )
-            # Extract single list containing all neighbours of nodes that raised an anomaly
-            single_list_neighbours = [
-                node
-                for feature_anom in features
-                for node in neighborhoods_dict[feature_anom]
-            ]
-            single_list_neighbours = list(set(single_list_neighbours))
-            # Extract single list of anomalous nodes (nodes raising anomaly + neighbours)
-            anomalous_nodes = [
-                node
-                for feature_anom in features
-                for node in nodes_to_check_dict[feature_anom]
-            ]
-            anomalous_nodes = list(set(anomalous_nodes))
-            # Extract single list of anomalous nodes (nodes raising anomaly + neighbours)
-            anomalous_nodes_full_name = [
-                node
-                for feature_anom in features
-                for node in nodes_to_check_full_name_dict[feature_anom]
-            ]
-            anomalous_nodes_full_name = list(set(anomalous_nodes_full_name))
-            # Check if dodag changed or not
-
-            dodag_changed, nodes_changing = extract_dodag_before_after(
-                daos,
-                single_list_nodes_raising_anomaly,
-                single_list_neighbours,
-                time_seconds,
-                args,
-            )
 
-            # Classify the attack
-            classify_attack_from_dodag(
-                all_series_attack_classification,
-                anomalous_nodes_full_name,
-                nodes_changing,  # anomalous_nodes_full_name,
-                time_step + train_length,
-                dodag_changed,
-                list_communicating_nodes_from_train,
-                output_file,
-                args,
-            )
+    if args.prescreen != "none":
+        print(f"Pre-screen avoided {avoided_fits} fits in total")
+    print(f"Forecasts by path: {dict(detectors.path_counts)}")
+    if forecasts is not None:
+        print(f"Forecast cache hit rate: {forecasts.hit_rate():.3f}")
+        forecasts.save()
 
-    # Closes txt file
-    output_file.close()
-    # Plot prediction times using box plot
+
+def main():
+    tic_main = tm.perf_counter()
+    args = settings_parser.arg_parse()
+    if args.ids_jobs:
+        run_batch(_parse_jobs(args.ids_jobs), args)
+    else:
+        run_simulation(args)
     toc_main = tm.perf_counter()
     print(f"Whole main took: {toc_main - tic_main}")
 
 
-def _arima_fit(
-    histories, feature, node_index, all_files, tests, time_step, time_seconds, alpha
+def classify_anomaly(
+    features,
+    list_nodes_raising_anomaly,
+    list_nodes_raising_anomaly_full_name,
+    dios,
+    daos,
+    features_series,
+    time_seconds,
+    time_step,
+    nodes_in_train,
+    output_file,
+    args,
+    classifier_detectors=None,
+):
+    """
+    Get the neighborhood of the nodes raising an anomaly, check the DODAG and classify
+    the attack, writing the anomaly and the attack in the output file
+    :param time_step: index of the window of the anomaly in features_series
+    :param classifier_detectors: detectors of the attack classification by node and
+        feature, kept between the anomalies of a simulation
+    """
+    neighborhoods_dict = {feature: [] for feature in features}
+    neighborhoods_full_name_dict = {feature: [] for feature in features}
+    nodes_to_check_dict = {feature: [] for feature in features}
+    nodes_to_check_full_name_dict = {feature: [] for feature in features}
+    # Neighbors without statistics, e.g. nodes that have not sent any yet, are not
+    # checked
+    known_nodes = features_series[args.attack_classification_features[0]]
+    known_short_names = {node.split("-")[-1] for node in known_nodes}
+
+    for feature in features:
+        neighborhood_full_name, neighborhood = extract_neighborhood(
+            dios,
+            list_nodes_raising_anomaly_full_name[feature],
+            time_seconds,
+            args,
+        )
+        neighborhoods_full_name_dict[feature] = [
+            node for node in neighborhood_full_name if node in known_nodes
+        ]
+        neighborhoods_dict[feature] = [
+            node for node in neighborhood if node in known_short_names
+        ]
+        # Nodes to check are the ones that have raised anomalies and their neighbours
+        nodes_to_check_dict[feature] = (
+            list_nodes_raising_anomaly[feature] + neighborhoods_dict[feature]
+        )
+        nodes_to_check_full_name_dict[feature] = (
+            list_nodes_raising_anomaly_full_name[feature]
+            + neighborhoods_full_name_dict[feature]
+        )
+    # Extract single list containing all nodes that raised an anomaly in either feature
+    single_list_nodes_raising_anomaly = [
+        node
+        for feature_anom in features
+        for node in list_nodes_raising_anomaly[feature_anom]
+    ]
+    single_list_nodes_raising_anomaly = list(set(single_list_nodes_raising_anomaly))
+    # Print anomaly and nodes involved in the output file
+    output_file.write(
+        f"Anomaly raised at time {time_seconds}. "
+        f"Devices involved: {list_nodes_raising_anomaly}\n"
+    )
+    # Extract single list containing all neighbours of nodes that raised an anomaly
+    single_list_neighbours = [
+        node for feature_anom in features for node in neighborhoods_dict[feature_anom]
+    ]
+    single_list_neighbours = list(set(single_list_neighbours))
+    # Extract single list of anomalous nodes (nodes raising anomaly + neighbours)
+    anomalous_nodes = [
+        node for feature_anom in features for node in nodes_to_check_dict[feature_anom]
+    ]
+    anomalous_nodes = list(set(anomalous_nodes))
+    # Extract single list of anomalous nodes (nodes raising anomaly + neighbours)
+    anomalous_nodes_full_name = [
+        node
+        for feature_anom in features
+        for node in nodes_to_check_full_name_dict[feature_anom]
+    ]
+    anomalous_nodes_full_name = list(set(anomalous_nodes_full_name))
+    # Check if dodag changed or not
+
+    dodag_changed, nodes_changing = extract_dodag_before_after(
+        daos,
+        single_list_nodes_raising_anomaly,
+        single_list_neighbours,
+        time_seconds,
+        args,
+    )
+
+    # Classify the attack
+    classify_attack_from_dodag(
+        features_series,
+        anomalous_nodes_full_name,
+        nodes_changing,  # anomalous_nodes_full_name,
+        time_step,
+        dodag_changed,
+        nodes_in_train,
+        output_file,
+        args,
+        classifier_detectors,
+    )
+
+
+def _detector_fit(
+    shared_series,
+    feature,
+    feature_index,
+    node_name,
+    node_index,
+    size,
+    time_step,
+    time_seconds,
+    alpha,
+    detector,
+    args,
+):
+    # History and observed value are read from the (feature x node x time) shared series
+    series = _get_shared_series(shared_series)[feature_index, node_index]
+    return detector_check(
+        series[time_step : time_step + size],
+        series[time_step + size],
+        feature,
+        node_name,
+        time_step,
+        time_seconds,
+        alpha,
+        detector,
+        args,
+    )
+
+
+def detector_check(
+    history,
+    observed,
+    feature,
+    node_name,
+    time_step,
+    time_seconds,
+    alpha,
+    detector,
+    args,
 ):
-    node_name = all_files[node_index].split("/")[-1].split("_")[0]
-    node_full_name = all_files[node_index].split("/")[-1].split("_")[0]
+    # Forecast the observed value from the history with the detector of the series,
+    # fitting a new detector if there is none
+    node_full_name = node_name
     conf_int = [[-0.1, 0.1] for x in range(1)]
     output = 0
     # Monitor also time efficiency
     tic = tm.perf_counter()
-    # Try to fit arima since it may return errors depending on matrices rank
+    # Try to fit the detector since ARIMA may return errors depending on matrices rank
     try:
         warnings.filterwarnings("ignore")
-        model = pm.auto_arima(
-            histories[feature][node_name],
-            start_p=1,
-            start_q=1,
-            test="adf",  # use adftest to find optimal 'd'
-            max_p=3,
-            max_q=3,  # maximum p and q
-            m=1,  # frequency of series
-            d=None,  # let model determine 'd'
-            seasonal=False,  # No Seasonality
-            start_P=0,
-            D=0,  # Minimum differencing order
-            trace=False,
-            error_action="ignore",
-            suppress_warnings=True,
-            stepwise=True,
-        )
-        output, conf_int = model.predict(n_periods=1, return_conf_int=True, alpha=alpha)
+        if detector is None:
+            detector = detectors.get_detector(args)
+            detector.fit(history, time_step)
+        elif detector.window != time_step - 1:
+            # Fit again on the whole history after time steps skipped by the pre-screen
+            detector.fit(history, time_step)
+        else:
+            # The last value of the history is the one observed in the previous time step
+            detector.update(history[-1])
+        output, conf_int = detector.predict_interval(alpha)
     except:
         pass
     toc = tm.perf_counter()
     single_pred_time = toc - tic
     # Append prediction and confidence interval to the corresponding dictionary entry
     # If real value is outside confidence range it is considered an anomaly
-    if (
-        tests[feature][node_name][time_step] < conf_int[0][0]
-        or tests[feature][node_name][time_step] > conf_int[0][1]
-    ):
+    if observed < conf_int[0][0] or observed > conf_int[0][1]:
         # Update list of nodes to be checked and raise the anomaly
         node_raising_anomaly = node_name
         node_raising_anomaly_full_name = node_full_name
@@ -499,8 +810,108 @@ def _arima_fit(
         conf_int,
         node_raising_anomaly,
         node_raising_anomaly_full_name,
+        detector,
     )
 
 
+def prescreen(series, size, time_step, args):
+    """
+    Check the observations of all features and nodes against their histories at once:
+    range: within the history min and max, widened by prescreen_margin times the range
+    zscore: within the history mean +- prescreen_k standard deviations
+    :param series: (feature x node x time) array
+    :return: (feature x node) array, True if the series must be checked by its detector,
+        and (feature x node x 2) array of the intervals of the pre-screen
+    """
+    histories = series[:, :, time_step : time_step + size]
+    observed = series[:, :, time_step + size]
+    if args.prescreen == "none":
+        return np.ones(observed.shape, dtype=bool), None
+    if args.prescreen == "range":
+        lower, upper = histories.min(axis=2), histories.max(axis=2)
+        margin = args.prescreen_margin * (upper - lower)
+        lower, upper = lower - margin, upper + margin
+    elif args.prescreen == "zscore":
+        mean, std = histories.mean(axis=2), histories.std(axis=2)
+        lower, upper = mean - args.prescreen_k * std, mean + args.prescreen_k * std
+    else:
+        raise ValueError(
+            f"Unknown prescreen {args.prescreen}, possibilities: none, range, zscore"
+        )
+    return (observed < lower) | (observed > upper), np.stack([lower, upper], axis=2)
+
+
+def screened_output(screen_interval, detector):
+    # Output of a series passing the pre-screen, in the same format as _detector_fit
+    return (
+        0.0,
+        np.array([screen_interval.mean()]),
+        screen_interval[None],
+        [],
+        [],
+        detector,
+    )
+
+
+def closed_form_output(
+    forecast, conf_int, observed, feature, node_name, time_seconds, detector
+):
+    # Output of a series forecast without its detector (degenerate history or cached
+    # forecast), in the same format as _detector_fit
+    if observed < conf_int[0] or observed > conf_int[1]:
+        print(
+            f"Anomaly found in node {node_name} at time {time_seconds} for feature {feature}"
+        )
+        node_raising_anomaly = node_name
+    else:
+        node_raising_anomaly = []
+    return (
+        0.0,
+        np.array([forecast]),
+        conf_int[None],
+        node_raising_anomaly,
+        node_raising_anomaly,
+        detector,
+    )
+
+
+def batch_ar_fit(
+    series, features, node_names, size, time_step, time_seconds, alpha, args
+):
+    """
+    Forecast all nodes and features of a time step with batched AR models
+    :param series: (feature x node x time) array
+    :return: one output per feature and node, in the same format as _detector_fit
+    """
+    outputs = []
+    for feature_index, feature in enumerate(features):
+        tic = tm.perf_counter()
+        histories = series[feature_index, :, time_step : time_step + size]
+        observed = series[feature_index, :, time_step + size]
+        forecasts, conf_ints = batch_ar.forecast_intervals(
+            histories, alpha, args.ar_order, args.ar_diff
+        )
+        single_pred_time = (tm.perf_counter() - tic) / len(node_names)
+        anomalous = (observed < conf_ints[:, 0]) | (observed > conf_ints[:, 1])
+        for node_index, node_name in enumerate(node_names):
+            if anomalous[node_index]:
+                print(
+                    f"Anomaly found in node {node_name} at time {time_seconds} "
+                    f"for feature {feature}"
+                )
+            node_raising_anomaly = node_name if anomalous[node_index] else []
+            outputs.append(
+                (
+                    single_pred_time,
+                    forecasts[node_index : node_index + 1],
+                    conf_ints[node_index : node_index + 1],
+                    node_raising_anomaly,
+                    node_raising_anomaly,
+                    None,
+                )
+            )
+    return outputs
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,74 @@
+"""
+Statistics of all nodes of a simulation, loaded once into a contiguous
+(feature x node x window) array. Nodes and features are indexed by integer position,
+the series of a node and feature is a contiguous view of the array.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class NodeSeriesStore:
+    """
+    Series of every feature and node of a simulation
+    node_names: names of the nodes, in the order of the node axis
+    feature_names: names of the features, in the order of the feature axis
+    values: (feature x node x window) float array
+    """
+
+    def __init__(self, node_names, feature_names, values):
+        self.node_names = list(node_names)
+        self.feature_names = list(feature_names)
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.node_index = {node: index for index, node in enumerate(self.node_names)}
+        self.feature_index = {
+            feature: index for index, feature in enumerate(self.feature_names)
+        }
+
+    @classmethod
+    def from_simulation(cls, simulation):
+        # The simulation store keeps the features as (node x window x feature)
+        return cls(
+            simulation.nodes_names,
+            simulation.feature_names,
+            np.transpose(simulation.features, (2, 0, 1)),
+        )
+
+    @classmethod
+    def from_csv(cls, files):
+        """
+        Read the stats csv file of each node once
+        :param files: stats files, named after their node
+        """
+        node_names = [os.path.basename(file).split("_")[0] for file in files]
+        stats = [pd.read_csv(file) for file in files]
+        feature_names = list(stats[0].columns) if stats else []
+        values = np.empty(
+            (len(feature_names), len(files), len(stats[0]) if stats else 0)
+        )
+        for node_index, node_stats in enumerate(stats):
+            values[:, node_index] = node_stats[feature_names].values.T
+        return cls(node_names, feature_names, values)
+
+    @property
+    def n_windows(self):
+        return self.values.shape[2]
+
+    def series(self, feature, node):
+        # Contiguous view of the series of a node and feature
+        return self.values[self.feature_index[feature], self.node_index[node]]
+
+    def features(self, features):
+        # (feature x node x window) copy of the series of the given features
+        return self.values[[self.feature_index[feature] for feature in features]]
+
+    def series_dict(self, features):
+        # Views of the series by feature and node name
+        return {
+            feature: {
+                node: self.values[self.feature_index[feature], node_index]
+                for node, node_index in self.node_index.items()
+            }
+            for feature in features
+        }
@@ -4,24 +4,37 @@ files of statistics for each time window, for each node
 file of neighbors for each time window, for each node
 all DAOs received by the border router
 """
-import ast
+
 import csv
+import hashlib
+import io
+import json
 import math
 import os
+import re
 
 import numpy as np
 import pandas as pd
 
+import feature_store
 import settings_parser
+import trace_schema
 
+# Matches each node ID of a neighbor list such as "[2, 5, 7]"
+_NEIGHBOR_ID = re.compile(r"\d+")
 
-def _get_data(path_to_file):
-    # Read csv file
-    data = pd.read_csv(path_to_file, index_col=False)
-    return data
+# Parameters the parsed outputs depend on, recorded with the hash of the traces
+_MANIFEST_PARAMETERS = (
+    "time_window",
+    "simulation_time",
+    "max_nr_neighbors",
+    "time_feat_micro",
+    "attack_classification_features",
+    "feature_store",
+)
 
 
-def _get_unique_nodes_names(data):
+def get_unique_nodes_names(data):
     # Get names of transmitter devices
     nodes_names = data["SENDER_ID"].unique()
     # Remove nan values
@@ -31,7 +44,7 @@ def _get_unique_nodes_names(data):
     return nodes_names
 
 
-def _parse_stats_timewindow(stats, feature_list):
+def parse_stats_timewindow(stats, feature_list):
     features = np.zeros(len(feature_list), dtype=float)
     neighbors = []
     # Get number of DIO received
@@ -70,164 +83,668 @@ def _parse_stats_timewindow(stats, feature_list):
     else:
         features[10] = nr_outgoing / nr_incoming
     # List of neighbors
-    for i, neighbor in enumerate(stats["NEIGHBORS"]):
-        nbrs = ast.literal_eval(list(stats["NEIGHBORS"])[i])
-        for count, nbr in enumerate(nbrs):
-            neighbors.append(nbr)
+    _, nbr_ids = _decode_neighbors(stats["NEIGHBORS"])
+    neighbors = nbr_ids.tolist()
     return features, neighbors
 
 
-def _create_neighbors_file_for_node(args, neighbor_list, node):
-    with open(
+def _decode_neighbors(neighbors_column):
+    """
+    Decode a column of neighbor lists such as "[2, 5, 7]" into integer node IDs in one pass
+    :return: (offsets, ids), the neighbors of row i are ids[offsets[i]:offsets[i + 1]]
+    """
+    rows = [_NEIGHBOR_ID.findall(nbrs) for nbrs in neighbors_column.astype(str)]
+    offsets = np.zeros(len(rows) + 1, dtype=int)
+    np.cumsum([len(row) for row in rows], out=offsets[1:])
+    ids = np.fromiter(
+        (int(nbr) for row in rows for nbr in row), dtype=int, count=offsets[-1]
+    )
+    return offsets, ids
+
+
+def _get_window_neighbors(neighbors, first_window, last_window):
+    # Get the neighbor lists of a range of windows from the (offsets, ids) structure
+    offsets, ids = neighbors
+    return [
+        ids[offsets[window] : offsets[window + 1]].tolist()
+        for window in range(first_window, last_window)
+    ]
+
+
+def get_nr_windows(args):
+    return int(math.floor(args.simulation_time) / args.time_window)
+
+
+def get_window_index(times, args):
+    # Window i holds the packets received in (i * time_window, (i + 1) * time_window]
+    return np.ceil(np.asarray(times) / (args.time_window * 1e6)).astype(int) - 1
+
+
+def _bin_stats(data, nodes_names, n_windows, args):
+    # Keep the packets of the given nodes within the simulation and add their window index
+    data = data[data["SENDER_ID"].isin(nodes_names)]
+    window = get_window_index(data[args.time_feat_micro].values, args)
+    in_range = (window >= 0) & (window < n_windows)
+    return data[in_range].assign(WINDOW=window[in_range])
+
+
+def _aggregate_windows(data):
+    """
+    Aggregate binned packets by node and time window
+    :return: dataframe indexed by (SENDER_ID, WINDOW) with the summed counters, the last rank
+    and version and the last non-zero rank and version change times (NaN if none)
+    """
+    grouped = data.groupby(["SENDER_ID", "WINDOW"], sort=False, observed=True)
+    windows = grouped[
+        ["DIO_rcvd", "APP_rcvd", "DAO_txd", "DIO_txd", "DIS_txd", "APP_txd"]
+    ].sum()
+    # Current rank and version are taken from the last packet of the window
+    last_rows = data.drop_duplicates(["SENDER_ID", "WINDOW"], keep="last").set_index(
+        ["SENDER_ID", "WINDOW"]
+    )
+    windows["CURRENT_RANK"] = last_rows["CURRENT_RANK"]
+    windows["CURRENT_VERSION"] = last_rows["CURRENT_VERSION"]
+    # Time for rank and version change is the last non-zero value of the window
+    change_times = data[["RANK_CHANGE_TIME", "VERSION_CHANGE_TIME"]].replace(0, np.nan)
+    change_times = change_times.groupby(
+        [data["SENDER_ID"], data["WINDOW"]], observed=True
+    ).last()
+    windows["RANK_CHANGE_TIME"] = change_times["RANK_CHANGE_TIME"]
+    windows["VERSION_CHANGE_TIME"] = change_times["VERSION_CHANGE_TIME"]
+    return windows
+
+
+def _get_window_features(windows, has_packets):
+    """
+    Compute the features of each node and time window from the aggregated windows
+    :param windows: (node x window x 10) array of aggregated windows, see _aggregate_windows
+    :param has_packets: (node x window) array, True if the node sent packets in the window
+    :return: (node x window x feature) array
+    """
+    windows = np.nan_to_num(windows)
+    # Set nr of incoming vs outgoing
+    nr_incoming = windows[:, :, 1]
+    nr_outgoing = windows[:, :, 5]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        incoming_vs_outgoing = np.where(
+            (nr_incoming == nr_outgoing) | (nr_incoming == 0),
+            1,
+            nr_outgoing / nr_incoming,
+        )
+    features = np.dstack([windows, incoming_vs_outgoing])
+    # Windows without packets keep the values of the previous window of the node
+    source = np.maximum.accumulate(
+        np.where(has_packets, np.arange(has_packets.shape[1]), -1), axis=1
+    )
+    features = np.take_along_axis(features, np.maximum(source, 0)[:, :, None], axis=1)
+    features[source < 0] = 0
+    return features
+
+
+def _parse_stats_windows(data, nodes_names, args):
+    """
+    Extract the features of every node and time window from a single groupby.
+    Gives the same features as parse_stats_timewindow without building a mask per window.
+    :return: (node x window x feature) array and (offsets, ids) of the neighbors per window
+    """
+    n_windows = get_nr_windows(args)
+    # Bin each packet once by sender and time window
+    data = _bin_stats(data, nodes_names, n_windows, args)
+    windows = _aggregate_windows(data)
+    full_index = pd.MultiIndex.from_product(
+        [nodes_names, range(n_windows)], names=["SENDER_ID", "WINDOW"]
+    )
+    windows = windows.reindex(full_index)
+    has_packets = (
+        windows["DIO_rcvd"].notna().values.reshape(len(nodes_names), n_windows)
+    )
+    features = _get_window_features(
+        windows.values.astype(float).reshape(len(nodes_names), n_windows, -1),
+        has_packets,
+    )
+    neighbors = _fill_empty_windows_neighbors(
+        _group_neighbors_by_window(data, nodes_names, n_windows), has_packets
+    )
+    return features, neighbors
+
+
+def _group_neighbors_by_window(data, nodes_names, n_windows):
+    """
+    Group the decoded neighbors of all packets by node and time window
+    :return: (offsets, ids), the neighbors of window w of node n are
+    ids[offsets[n * n_windows + w]:offsets[n * n_windows + w + 1]]
+    """
+    n_slots = len(nodes_names) * n_windows
+    packet_offsets, packet_ids = _decode_neighbors(data["NEIGHBORS"])
+    # Slot (node, window) of each packet and of each neighbor ID
+    packet_slots = (
+        pd.Index(nodes_names).get_indexer(data["SENDER_ID"]) * n_windows
+        + data["WINDOW"].values
+    )
+    id_slots = np.repeat(packet_slots, np.diff(packet_offsets))
+    # Stable sort keeps the neighbors of a window in packet order
+    slot_ids = packet_ids[np.argsort(id_slots, kind="stable")]
+    slot_offsets = np.zeros(n_slots + 1, dtype=int)
+    np.cumsum(np.bincount(id_slots, minlength=n_slots), out=slot_offsets[1:])
+    return slot_offsets, slot_ids
+
+
+def _fill_empty_windows_neighbors(neighbors, has_packets):
+    # Windows without packets keep the neighbors of the previous window of the node
+    slot_offsets, slot_ids = neighbors
+    n_windows = has_packets.shape[1]
+    slots = np.arange(has_packets.size)
+    source = np.maximum.accumulate(np.where(has_packets.ravel(), slots, -1))
+    source = np.where(source >= slots - slots % n_windows, source, -1)
+    counts = np.where(source >= 0, slot_offsets[source + 1] - slot_offsets[source], 0)
+    offsets = np.zeros(has_packets.size + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+    ids = slot_ids[
+        np.repeat(slot_offsets[source] - offsets[:-1], counts) + np.arange(offsets[-1])
+    ]
+    return offsets, ids
+
+
+class _StatsAccumulator:
+    """
+    Fold chunks of a stats trace into per-node window accumulators, so that memory depends
+    on the number of nodes and windows rather than on the length of the trace.
+    Chunks must be added in the order of the trace.
+    """
+
+    def __init__(self, n_windows):
+        self.n_windows = n_windows
+        self.nodes_names = []
+        # Aggregated windows of each node, NaN until the node sends a packet in the window
+        self.windows = np.full((0, n_windows, 10), np.nan)
+        # Unique neighbors of each (node, window) slot in order of appearance
+        self.neighbors = {}
+
+    def add_chunk(self, chunk, args):
+        # Register nodes seen for the first time
+        new_nodes = [
+            node
+            for node in get_unique_nodes_names(chunk)
+            if node not in self.nodes_names
+        ]
+        if new_nodes:
+            self.nodes_names = self.nodes_names + new_nodes
+            self.windows = np.concatenate(
+                [self.windows, np.full((len(new_nodes), self.n_windows, 10), np.nan)]
+            )
+        data = _bin_stats(chunk, self.nodes_names, self.n_windows, args)
+        windows = _aggregate_windows(data)
+        node_index = pd.Index(self.nodes_names).get_indexer(
+            windows.index.get_level_values(0)
+        )
+        window = windows.index.get_level_values(1).values
+        values = windows.values.astype(float)
+        current = self.windows[node_index, window]
+        # Counters are summed over chunks
+        current[:, :6] = np.nan_to_num(current[:, :6]) + values[:, :6]
+        # Later chunks overwrite the last rank, version and change times
+        current[:, 6:] = np.where(
+            np.isnan(values[:, 6:]), current[:, 6:], values[:, 6:]
+        )
+        self.windows[node_index, window] = current
+        # Add neighbors of the chunk to the set of each slot
+        slot_offsets, slot_ids = _group_neighbors_by_window(
+            data, self.nodes_names, self.n_windows
+        )
+        for slot in np.flatnonzero(np.diff(slot_offsets)):
+            self.neighbors.setdefault(slot, {}).update(
+                dict.fromkeys(slot_ids[slot_offsets[slot] : slot_offsets[slot + 1]])
+            )
+
+    def get_features(self):
+        return _get_window_features(self.windows, ~np.isnan(self.windows[:, :, 0]))
+
+    def get_state(self):
+        # Arrays holding the whole state of the accumulator
+        slots = np.array(sorted(self.neighbors), dtype=int)
+        counts = [len(self.neighbors[slot]) for slot in slots]
+        return {
+            "nodes_names": np.asarray(self.nodes_names, dtype=str),
+            "windows": self.windows,
+            "neighbor_slots": slots,
+            "neighbor_counts": np.asarray(counts, dtype=int),
+            "neighbor_ids": np.fromiter(
+                (nbr for slot in slots for nbr in self.neighbors[slot]),
+                dtype=int,
+                count=sum(counts),
+            ),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls(state["windows"].shape[1])
+        accumulator.nodes_names = state["nodes_names"].tolist()
+        accumulator.windows = state["windows"]
+        offsets = np.concatenate([[0], np.cumsum(state["neighbor_counts"])])
+        for index, slot in enumerate(state["neighbor_slots"].tolist()):
+            accumulator.neighbors[slot] = dict.fromkeys(
+                state["neighbor_ids"][offsets[index] : offsets[index + 1]].tolist()
+            )
+        return accumulator
+
+    def get_neighbors(self):
+        n_slots = len(self.nodes_names) * self.n_windows
+        slot_offsets = np.zeros(n_slots + 1, dtype=int)
+        for slot, neighbors in self.neighbors.items():
+            slot_offsets[slot + 1] = len(neighbors)
+        np.cumsum(slot_offsets, out=slot_offsets)
+        slot_ids = np.fromiter(
+            (nbr for slot in sorted(self.neighbors) for nbr in self.neighbors[slot]),
+            dtype=int,
+            count=slot_offsets[-1],
+        )
+        return _fill_empty_windows_neighbors(
+            (slot_offsets, slot_ids), ~np.isnan(self.windows[:, :, 0])
+        )
+
+
+def _parse_stats_streaming(path_to_file, args):
+    # Read the stats trace in chunks and fold each chunk into the window accumulators
+    accumulator = _StatsAccumulator(get_nr_windows(args))
+    for chunk in trace_schema.read_stats(path_to_file, chunksize=args.chunk_size):
+        accumulator.add_chunk(chunk, args)
+    return (
+        accumulator.nodes_names,
+        accumulator.get_features(),
+        accumulator.get_neighbors(),
+    )
+
+
+def _read_new_rows(path_to_file, offset):
+    """
+    Read the complete lines appended to a csv file after a byte offset
+    :return: header line, new lines and byte offset after the last complete line
+    """
+    with open(path_to_file, "rb") as trace:
+        header = trace.readline()
+        offset = max(offset, len(header))
+        trace.seek(offset)
+        new_rows = trace.read()
+    # A line that is still being written is left for the next run
+    new_rows = new_rows[: new_rows.rfind(b"\n") + 1]
+    return header, new_rows, offset + len(new_rows)
+
+
+def get_trace_path(args, trace):
+    # Path of the stats or dao trace of the simulation
+    return os.path.join(
+        os.getcwd(),
+        "..",
+        args.data_dir,
+        args.scenario,
+        f"Packet_Trace_{args.simulation_time}s",
+        f"{args.chosen_simulation}_{trace}.csv",
+    )
+
+
+def _get_state_path(args):
+    return (
         f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
-        f"simulation-{args.chosen_simulation}/{node}_neighbors.csv",
-        "w",
-        encoding="utf8",
-    ) as neighbor_file:
-        writer = csv.writer(neighbor_file)
-        columns_neighbors = list(range(args.max_nr_neighbors))
-        writer.writerow(columns_neighbors)
-        for neighbors in neighbor_list:
-            neighbors = list(set(neighbors))
-            row = list(range(args.max_nr_neighbors))
-            for i in range(len(columns_neighbors)):
-                if i < len(neighbors):
-                    row[i] = str(neighbors[i])
-                else:
-                    row[i] = 0
-            writer.writerow(row)
-
-
-def _create_dao_file(args):
+        f"simulation-{args.chosen_simulation}.state.npz"
+    )
+
+
+def _load_parse_state(path_to_stats, args):
+    # Resume from the watermark of the last run unless the trace has been replaced
+    with open(path_to_stats, "rb") as trace:
+        header = trace.readline()
+    if os.path.exists(_get_state_path(args)):
+        with np.load(_get_state_path(args)) as state:
+            if (
+                state["header"].tobytes() == header
+                and state["offset"] <= os.path.getsize(path_to_stats)
+                and state["windows"].shape[1] == get_nr_windows(args)
+            ):
+                return (
+                    _StatsAccumulator.from_state(state),
+                    int(state["offset"]),
+                    float(state["last_time"]),
+                    int(state["written_windows"]),
+                    state["written_nodes"].tolist(),
+                )
+    return _StatsAccumulator(get_nr_windows(args)), 0, 0.0, 0, []
+
+
+def _save_parse_state(args, accumulator, header, offset, last_time, written_windows):
+    # Save the watermark and the accumulators, including the windows still open
+    if not os.path.exists(os.path.dirname(_get_state_path(args))):
+        os.makedirs(os.path.dirname(_get_state_path(args)))
+    np.savez(
+        _get_state_path(args),
+        header=np.frombuffer(header, dtype=np.uint8),
+        offset=offset,
+        last_time=last_time,
+        written_windows=written_windows,
+        written_nodes=np.asarray(accumulator.nodes_names, dtype=str),
+        **accumulator.get_state(),
+    )
+
+
+def _parse_stats_incremental(path_to_stats, args):
+    """
+    Parse only the rows appended to the stats trace since the last run.
+    A watermark (byte offset and last TIME) and the window accumulators are kept in a
+    state file, and only windows that are closed are appended to the output files.
+    """
+    accumulator, offset, last_time, written_windows, written_nodes = _load_parse_state(
+        path_to_stats, args
+    )
+    header, new_rows, offset = _read_new_rows(path_to_stats, offset)
+    if new_rows:
+        chunks = trace_schema.read_stats(
+            io.BytesIO(header + new_rows),
+            chunksize=args.chunk_size if args.chunk_size > 0 else None,
+        )
+        for chunk in [chunks] if args.chunk_size <= 0 else chunks:
+            accumulator.add_chunk(chunk, args)
+            last_time = max(last_time, chunk[args.time_feat_micro].max())
+    nodes_names = accumulator.nodes_names
+    if not nodes_names:
+        # No complete row of a node yet, e.g. a trace that has just been started
+        _save_parse_state(args, accumulator, header, offset, last_time, written_windows)
+        return
+    # A window is closed once a row of a later window has been read, rows at the end of
+    # the window of the last row may still come. All windows are closed when the trace
+    # is final
+    n_windows = accumulator.n_windows
+    if args.incremental == "final":
+        closed_windows = n_windows
+    else:
+        closed_windows = int(min(max(get_window_index(last_time, args), 0), n_windows))
+    all_features = accumulator.get_features()[:, :closed_windows]
+    all_neighbors = accumulator.get_neighbors()
+    all_neighbor_rows = np.stack(
+        [
+            get_neighbor_rows(
+                args,
+                _get_window_neighbors(
+                    all_neighbors,
+                    node_index * n_windows,
+                    node_index * n_windows + closed_windows,
+                ),
+            )
+            for node_index in range(len(nodes_names))
+        ]
+    )
+    all_daos = _get_dao_data(args)
+    all_changed_parent = _create_changed_parent_columns(args, all_daos, nodes_names)[
+        :, :closed_windows
+    ]
+
+    if args.feature_store == "npz":
+        feature_store.save_simulation(
+            args,
+            feature_store.SimulationFeatures(
+                nodes_names=nodes_names,
+                feature_names=args.attack_classification_features,
+                features=np.dstack([all_features, all_changed_parent]),
+                neighbors=all_neighbor_rows,
+                daos=all_daos,
+            ),
+        )
+    else:
+        _write_simulation_files(
+            args,
+            nodes_names,
+            all_features,
+            all_changed_parent,
+            all_neighbor_rows,
+            all_daos,
+            written_windows,
+            written_nodes,
+        )
+
+    _save_parse_state(args, accumulator, header, offset, last_time, closed_windows)
+
+
+def _write_simulation_files(
+    args,
+    nodes_names,
+    all_features,
+    all_changed_parent,
+    all_neighbor_rows,
+    all_daos,
+    written_windows=0,
+    written_nodes=(),
+):
+    """
+    Write the file of all DAOs and the stats and neighbors files of each node.
+    The files of the nodes in written_nodes already hold their first written_windows
+    windows, the following windows are appended to them.
+    """
+    folder = (
+        f"{args.feat_folders}{args.scenario}/{args.simulation_time}"
+        f"/simulation-{args.chosen_simulation}"
+    )
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    # Create a file containing all DAOs sent
+    _create_dao_file(args, all_daos)
+    for node_index, node in enumerate(nodes_names):
+        append = node in written_nodes
+        first_window = written_windows if append else 0
+        mode = "a" if append else "w"
+        # Stats file of the node, column names with "changed parent" included
+        with open(f"{folder}/{node}_stats.csv", mode, encoding="utf8") as output_file:
+            writer = csv.writer(output_file)
+            if not append:
+                writer.writerow(args.attack_classification_features)
+            # One features row per time window
+            writer.writerows(
+                features + [changed_parent]
+                for features, changed_parent in zip(
+                    all_features[node_index, first_window:].tolist(),
+                    all_changed_parent[node_index, first_window:].tolist(),
+                )
+            )
+        # Neighbors file of the node
+        with open(
+            f"{folder}/{node}_neighbors.csv", mode, encoding="utf8"
+        ) as neighbor_file:
+            writer = csv.writer(neighbor_file)
+            if not append:
+                writer.writerow(list(range(args.max_nr_neighbors)))
+            writer.writerows(all_neighbor_rows[node_index, first_window:])
+
+
+def get_neighbor_rows(args, neighbor_list):
+    # One row of unique neighbors per time window, padded with 0 up to max_nr_neighbors
+    rows = np.zeros((len(neighbor_list), args.max_nr_neighbors), dtype=int)
+    for index, neighbors in enumerate(neighbor_list):
+        neighbors = list(set(neighbors))[: args.max_nr_neighbors]
+        rows[index, : len(neighbors)] = neighbors
+    return rows
+
+
+def _get_dao_data(args):
+    all_daos = trace_schema.read_daos(get_trace_path(args, "dao"))
+    return all_daos
+
+
+def _create_dao_file(args, all_daos):
     with open(
         f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
         f"simulation-{args.chosen_simulation}/all_DAOs.csv",
         "w",
         encoding="utf8",
     ) as daos_file:
-        all_daos = _get_data(
-            os.path.join(
-                os.getcwd(),
-                "..",
-                args.data_dir,
-                args.scenario,
-                f"Packet_Trace_{args.simulation_time}s",
-                args.chosen_simulation + "_dao.csv",
-            )
-        )
         all_daos.to_csv(daos_file, index=False)
-    return all_daos
 
 
-def _get_time_window_data(data, index, args, full_data=False):
-    time_window = args.time_window
-    if full_data:
-        start_time = args.time_start * 1e6
-    else:
-        start_time = index * time_window * 1e6
-    end_time = ((index + 1) * time_window) * 1e6
-    # Get all packets that have been received between start and end time (depending on window size)
-    condition = (data[args.time_feat_micro] > start_time) & (
-        data[args.time_feat_micro] <= end_time
-    )
-    sequence = data[condition]
-    return sequence
-
-
-def _create_changed_parent_column(args, all_daos, node):
-    changed_parent = np.zeros(int(args.simulation_time / args.time_window), dtype=int)
-    last_parent_id = ""
-    node_daos = all_daos[all_daos["SOURCE_ID"] == node]
-    for row in node_daos.iterrows():
-        parent = row[-1]["PARENT_ID"]
-        if not parent == last_parent_id:
-            time = row[-1]["TIME"]
-            time_step = int((time / 1e6) / args.time_window)
-            changed_parent[time_step] = 1
-        last_parent_id = row[-1]["PARENT_ID"]
+def _create_changed_parent_columns(args, all_daos, nodes_names):
+    changed_parent = np.zeros(
+        (len(nodes_names), int(args.simulation_time / args.time_window)), dtype=int
+    )
+    # Sort DAOs per node by time so that each DAO follows the previous DAO of the same node
+    daos = all_daos.sort_values(["SOURCE_ID", "TIME"], kind="mergesort")
+    # A node changed parent when its DAO has another parent than its previous DAO
+    # (the first DAO of each node always counts as a change)
+    changed = (daos["SOURCE_ID"] != daos["SOURCE_ID"].shift()) | (
+        daos["PARENT_ID"] != daos["PARENT_ID"].shift()
+    )
+    daos = daos[changed]
+    node_index = pd.Index(nodes_names).get_indexer(daos["SOURCE_ID"])
+    time_step = (daos["TIME"].values / 1e6 / args.time_window).astype(int)
+    valid = (node_index >= 0) & (time_step >= 0) & (time_step < changed_parent.shape[1])
+    changed_parent[node_index[valid], time_step[valid]] = 1
     return changed_parent
 
 
 def _parse_stats(args):
-    # Use attack classification features except "changed parent" which is added later
-    feature_list = args.attack_classification_features[
-        : len(args.attack_classification_features) - 1
-    ]
+    path_to_stats = get_trace_path(args, "stats")
+    if args.incremental in ("True", "final"):
+        _parse_stats_incremental(path_to_stats, args)
+        return
+    if args.chunk_size > 0:
+        # Stream the trace to bound memory on long simulations
+        nodes_names, all_features, all_neighbors = _parse_stats_streaming(
+            path_to_stats, args
+        )
+    else:
+        data = trace_schema.read_stats(path_to_stats)
+        nodes_names = get_unique_nodes_names(data)
+        # Extract features and neighbors of all nodes and time windows at once
+        all_features, all_neighbors = _parse_stats_windows(data, nodes_names, args)
+
+    n_windows = all_features.shape[1]
+    # Unique neighbors of all nodes and time windows, padded with 0
+    all_neighbor_rows = np.stack(
+        [
+            get_neighbor_rows(
+                args,
+                _get_window_neighbors(
+                    all_neighbors, node_index * n_windows, (node_index + 1) * n_windows
+                ),
+            )
+            for node_index in range(len(nodes_names))
+        ]
+    )
+    all_daos = _get_dao_data(args)
+    # Create columns of whether each node changed parent for timestep or not
+    all_changed_parent = _create_changed_parent_columns(args, all_daos, nodes_names)
 
-    data = _get_data(
-        os.path.join(
-            os.getcwd(),
-            "..",
-            args.data_dir,
-            args.scenario,
-            f"Packet_Trace_{args.simulation_time}s",
-            args.chosen_simulation + "_stats.csv",
+    if args.feature_store == "npz":
+        # Store features, neighbors and DAOs of the whole simulation in a single file
+        feature_store.save_simulation(
+            args,
+            feature_store.SimulationFeatures(
+                nodes_names=nodes_names,
+                feature_names=args.attack_classification_features,
+                features=np.dstack([all_features, all_changed_parent]),
+                neighbors=all_neighbor_rows,
+                daos=all_daos,
+            ),
         )
+        return
+
+    _write_simulation_files(
+        args,
+        nodes_names,
+        all_features,
+        all_changed_parent,
+        all_neighbor_rows,
+        all_daos,
     )
 
-    nodes_names = _get_unique_nodes_names(data)
 
-    for node in nodes_names:
-        if not os.path.exists(
-            f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
-            f"simulation-{args.chosen_simulation}"
-        ):
-            os.makedirs(
-                f"{args.feat_folders}{args.scenario}/{args.simulation_time}"
-                f"/simulation-{args.chosen_simulation}"
-            )
-        neighbor_list = []
-        # Create stats-file for node
-        with open(
-            f"{args.feat_folders}{args.scenario}/{args.simulation_time}"
-            f"/simulation-{args.chosen_simulation}/{node}_stats.csv",
-            "w",
-            encoding="utf8",
-        ) as output_file:
-            # Write column names to output file
-            writer = csv.writer(output_file)
-            writer.writerow(feature_list)
-            # Get all packets transmitted by node
-            id_condition = data["SENDER_ID"] == node
-            stats_packets = data[id_condition]
-            # Get index for windowing the network traffic
-            start_index = 0
-            end_index = math.floor(args.simulation_time) / args.time_window
-            # For each index get the corresponding network traffic window and extract the features
-            for index in range(int(start_index), int(end_index)):
-                # Get transmitted, received and all packets within the time window
-                stats = _get_time_window_data(
-                    stats_packets, index, args, full_data=False
-                )
-                if not stats.empty:
-                    features, neighbors = _parse_stats_timewindow(stats, feature_list)
-                neighbor_list.append(neighbors)
-                # Append the features row in feature file
-                writer.writerow(features)
-        # Create neighbors-file for node
-        _create_neighbors_file_for_node(args, neighbor_list, node)
-
-        # Create a file containing all DAOs sent
-        all_daos = _create_dao_file(args)
-
-        # Create column of whether node changed parent for timestep or not
-        changed_parent = _create_changed_parent_column(args, all_daos, node)
-        # Insert changed parent-column into stats-file
-        stats_csv = pd.read_csv(
-            f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
-            f"simulation-{args.chosen_simulation}/{node}_stats.csv",
-            index_col=False,
+def _get_manifest_path(args):
+    return (
+        f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
+        f"simulation-{args.chosen_simulation}.manifest.json"
+    )
+
+
+def _get_parse_hash(source_paths, args):
+    # Hash of the source traces and of the parameters the parsed outputs depend on
+    digest = hashlib.sha256()
+    for path in source_paths:
+        with open(path, "rb") as source_file:
+            for block in iter(lambda: source_file.read(1 << 20), b""):
+                digest.update(block)
+    parameters = {
+        parameter: getattr(args, parameter) for parameter in _MANIFEST_PARAMETERS
+    }
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _outputs_exist(args):
+    if args.feature_store == "npz":
+        return os.path.exists(feature_store.get_store_path(args))
+    return os.path.exists(
+        f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
+        f"simulation-{args.chosen_simulation}"
+    )
+
+
+def _is_cached(args, parse_hash):
+    if not os.path.exists(_get_manifest_path(args)) or not _outputs_exist(args):
+        return False
+    with open(_get_manifest_path(args), encoding="utf8") as manifest_file:
+        return json.load(manifest_file).get("hash") == parse_hash
+
+
+def _remove_manifest(args):
+    if os.path.exists(_get_manifest_path(args)):
+        os.remove(_get_manifest_path(args))
+
+
+def _save_manifest(args, source_paths, parse_hash):
+    with open(_get_manifest_path(args), "w", encoding="utf8") as manifest_file:
+        json.dump(
+            {
+                "hash": parse_hash,
+                "sources": [os.path.basename(path) for path in source_paths],
+                "parameters": {
+                    parameter: getattr(args, parameter)
+                    for parameter in _MANIFEST_PARAMETERS
+                },
+            },
+            manifest_file,
+            indent=4,
+        )
+
+
+def parse_simulation(args):
+    """
+    Parse the statistics and DAOs of one simulation, given by args.scenario and
+    args.chosen_simulation, into the feature files used by the IDS.
+    Outputs of a previous parse are reused if its manifest has the same hash of the traces
+    and parameters. Incremental parses do not use the manifest, their watermark tells
+    which rows are parsed, and their outputs may not cover the whole trace so they are
+    never reused by a later parse.
+    :return: True if the outputs were reused (cache hit), False if they were parsed
+    """
+    if args.incremental != "False":
+        _remove_manifest(args)
+        _parse_stats(args)
+        return False
+    source_paths = [get_trace_path(args, "stats"), get_trace_path(args, "dao")]
+    parse_hash = _get_parse_hash(source_paths, args)
+    if args.parse_cache == "True" and _is_cached(args, parse_hash):
+        print(
+            f"Cache hit: reusing parsed statistics of {args.scenario} "
+            f"simulation {args.chosen_simulation}"
         )
-        stats_csv.insert(11, "changed_parent", changed_parent)
-        stats_csv.to_csv(
-            f"{args.feat_folders}{args.scenario}/{args.simulation_time}/"
-            f"simulation-{args.chosen_simulation}/{node}_stats.csv"
+        return True
+    _parse_stats(args)
+    _save_manifest(args, source_paths, parse_hash)
+    if args.parse_cache == "True":
+        print(
+            f"Cache miss: parsed statistics of {args.scenario} "
+            f"simulation {args.chosen_simulation}"
         )
+    return False
 
 
 def main():
     args = settings_parser.arg_parse()
-    _parse_stats(args)
+    parse_simulation(args)
 
 
 if __name__ == "__main__":
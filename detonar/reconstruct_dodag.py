@@ -6,6 +6,7 @@ import networkx as nx
 
 # Python files
 import settings_parser
+import trace_schema
 
 
 def extract_data_up_to(data, time, args):
@@ -92,16 +93,18 @@ def extract_dodag_before_after(data, list_nodes, neighbors, time, args):
 def main():
     # Just a trial to check if the code works, the main shouldn't be used actually
     args = settings_parser.arg_parse()
-    window_time = 10
-    time_step = 25
-    time_anomaly = time_step * 10 + 10
-    extract_dodag_before_after(
+    daos = trace_schema.read_daos(
         os.path.join(
-            os.getcwd(), "..", args.data_dir, "Sinkhole", "Packet_Trace_600s/001.csv"
-        ),
-        time_anomaly,
-        window_time,
+            os.getcwd(),
+            "..",
+            args.data_dir,
+            args.scenario,
+            f"Packet_Trace_{args.simulation_time}s",
+            args.chosen_simulation + "_dao.csv",
+        )
     )
+    time_anomaly = 25 * args.time_window + args.time_window
+    print(extract_dodag_before_after(daos, [], [], time_anomaly, args))
 
 
 if __name__ == "__main__":
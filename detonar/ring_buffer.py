@@ -0,0 +1,50 @@
+"""
+Preallocated sliding window of the last values of series, with O(1) push.
+Every value is stored twice, at its position and one window length after it, so that
+the window of each series is always a contiguous view of the buffer.
+"""
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Last size values of a (...) array of series, e.g. (node) for the series of one
+    feature of all nodes
+    """
+
+    def __init__(self, shape, size, dtype=np.float64):
+        self.size = size
+        self.count = 0
+        # Position of the oldest value of the window
+        self._start = 0
+        self._values = np.zeros(tuple(shape) + (2 * size,), dtype=dtype)
+
+    def fill(self, history):
+        """
+        Replace the window with history
+        :param history: (... x time) array, only its last size values are kept
+        """
+        history = np.asarray(history)[..., -self.size :] if self.size else history
+        length = history.shape[-1]
+        self._start = 0
+        self.count = length
+        self._values[..., self.size - length : self.size] = history
+        self._values[..., 2 * self.size - length :] = history
+
+    def push(self, observations):
+        """
+        Add the observations of the next time step, dropping the oldest values once
+        the window is full
+        :param observations: (...) array or scalar
+        """
+        if not self.size:
+            raise ValueError("Cannot push to a ring buffer of size 0")
+        self._values[..., self._start] = observations
+        self._values[..., self._start + self.size] = observations
+        self._start = (self._start + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def view(self):
+        # (... x count) view of the window in time order, count is at most size
+        end = self._start + self.size
+        return self._values[..., end - self.count : end]
@@ -1,14 +1,18 @@
 """
 Run the DETONAR pipeline.
 """
+import argparse
 import datetime
 import glob
 import os
 import subprocess
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import PIPE, STDOUT, CalledProcessError
 
+import new_arima_ids
+import parse_statistics
 import summarize_output_files
 import settings_parser
 
@@ -74,6 +78,49 @@ def _get_simulations_csv(scenario, args):
     return list(set(simulations))
 
 
+def _parse_simulation(args):
+    # Parse one simulation in a worker, returning the error instead of raising it
+    try:
+        cached = parse_statistics.parse_simulation(args)
+        return args.scenario, args.chosen_simulation, cached, None
+    except Exception:  # pylint: disable=broad-except
+        return args.scenario, args.chosen_simulation, False, traceback.format_exc()
+
+
+def _parse_simulations(scenarios, args):
+    """
+    Parse all simulations of all scenarios in a pool of processes
+    :return: list of (scenario, simulation, traceback) for the simulations that failed
+    """
+    jobs = []
+    for scenario in scenarios:
+        for sim in _get_simulations_csv(scenario, args):
+            sim_args = argparse.Namespace(**vars(args))
+            sim_args.scenario = scenario
+            sim_args.chosen_simulation = sim
+            sim_args.lag_val = 30
+            sim_args.time_start = args.time_window
+            jobs.append(sim_args)
+
+    failures = []
+    cache_hits = 0
+    with ProcessPoolExecutor(max_workers=args.parse_workers or None) as executor:
+        for scenario, sim, cached, error in executor.map(_parse_simulation, jobs):
+            if error is None:
+                cache_hits += cached
+            else:
+                print(
+                    f"Parsing failed for scenario: {scenario} simulation: {sim}\n{error}",
+                    file=sys.stderr,
+                )
+                failures.append((scenario, sim, error))
+    print(
+        f"Parsed {len(jobs) - len(failures)}/{len(jobs)} simulations, "
+        f"cache hits: {cache_hits}, cache misses: {len(jobs) - cache_hits}\n"
+    )
+    return failures
+
+
 def main():
     """
     Run statistic parsing on a given dataset
@@ -92,19 +139,9 @@ def main():
         scenarios.append(scenario)
 
     # Parse statistics (instead of feature extraction)
-    for scenario in scenarios:
-        print("Parse statistics for scenario:", scenario, "\n")
-        simulations = _get_simulations_csv(scenario, args)
-        for sim in simulations:
-            cmd = (
-                f'python3 parse_statistics.py --scenario="{scenario}" --chosen_simulation="{sim}" '
-                f"--simulation_time={args.simulation_time} --feat_folders"
-                f"=\"{args.feat_folders}\" --time_window={args.time_window} "
-                f"--lag_val=30 --data_dir=\"{args.data_dir}\" "
-                f"--time_start={args.time_window} --time_feat_micro"
-                f"=\"{args.time_feat_micro}\" --max_nr_neighbors={args.max_nr_neighbors}"
-            )
-            _run_command(cmd)
+    print("Parse statistics for scenarios:", scenarios, "\n")
+    # Failures are reported with their traceback as they happen
+    _parse_simulations(scenarios, args)
 
     print("Running IDS\n")
     print(
@@ -117,24 +154,16 @@ def main():
         "\n\n",
     )
 
-    # For each scenario, create a list of simulations existing for that scenario
-    for scenario in scenarios:
-        # Getting files depending on data directory, scenario and simulation time chosen
-        simulations = _get_simulations(scenario, args)
-
-        # Run IDS for each simulation in scenario
-        for sim in simulations:
-
-            cmd = (
-                f'python3 new_arima_ids.py --scenario="{scenario}" --chosen_simulation='
-                f'"{sim}" --simulation_time={args.simulation_time} '
-                f'--time_window={args.time_window} --lag_val=30 --data_dir="{args.data_dir}" '
-                f'--output_dir="{args.output_dir}" '
-                f'--feat_folders="{args.feat_folders}" --time_start={args.time_window}'
-            )
-            print(cmd)
-            _run_command(cmd)
-
+    # Run IDS on all simulations of all scenarios in this process, sharing its workers
+    jobs = [
+        (scenario, sim)
+        for scenario in scenarios
+        for sim in _get_simulations(scenario, args)
+    ]
+    ids_args = argparse.Namespace(**vars(args))
+    ids_args.lag_val = 30
+    ids_args.time_start = args.time_window
+    new_arima_ids.run_batch(jobs, ids_args)
 
     cmd = f'python3 summarize_output_files.py --data_dir="{args.data_dir}" ' \
           f'--simulation_time={args.simulation_time} --time_window={args.time_window} ' \
@@ -65,6 +65,160 @@ def arg_parse():
         type=int,
         help="Feature used for creating the time series of neighbor-lists",
     )
+    parser.add_argument(
+        "--chunk_size",
+        default=0,
+        type=int,
+        help="if > 0, read the stats trace in chunks of this many rows to bound memory",
+    )
+    parser.add_argument(
+        "--incremental",
+        default="False",
+        type=str,
+        help="set to true to only parse rows appended to the stats trace since last run, "
+        "final to also close the last windows of a trace that is complete",
+    )
+    parser.add_argument(
+        "--parse_cache",
+        default="True",
+        type=str,
+        help="set to false to parse simulations again even if traces and parameters "
+        "are unchanged",
+    )
+    parser.add_argument(
+        "--parse_workers",
+        default=0,
+        type=int,
+        help="number of processes parsing simulations in run_pipeline, 0 for all cores",
+    )
+    parser.add_argument(
+        "--ids_workers",
+        default=0,
+        type=int,
+        help="number of processes fitting ARIMA models in the IDS, 0 for all cores",
+    )
+    parser.add_argument(
+        "--ids_jobs",
+        default="",
+        type=str,
+        help="run the IDS on several simulations in one process, as a comma separated "
+        "list of scenario/simulation, e.g. Blackhole/00001,Sinkhole/00002",
+    )
+    parser.add_argument(
+        "--forecaster",
+        default="auto_arima",
+        type=str,
+        help="forecaster of the IDS and of the attack classification: auto_arima "
+        "(ARIMA model of each node), batch_ar (AR models of all nodes fitted at once), "
+        "ewma, holt (linear exponential smoothing) or mad (median and median absolute "
+        "deviation)",
+    )
+    parser.add_argument(
+        "--ar_order",
+        default=2,
+        type=int,
+        help="number of lags of the batch_ar forecaster",
+    )
+    parser.add_argument(
+        "--ar_diff",
+        default=1,
+        type=int,
+        help="differencing order of the batch_ar forecaster",
+    )
+    parser.add_argument(
+        "--prescreen",
+        default="none",
+        type=str,
+        help="check observations against their histories before the forecaster and only "
+        "forecast those failing the check: none, range (history min and max) or zscore "
+        "(history mean and standard deviation), not supported by batch_ar",
+    )
+    parser.add_argument(
+        "--prescreen_margin",
+        default=0.1,
+        type=float,
+        help="range pre-screen: the history range is widened by this fraction of it",
+    )
+    parser.add_argument(
+        "--prescreen_k",
+        default=3.0,
+        type=float,
+        help="zscore pre-screen: number of standard deviations around the history mean",
+    )
+    parser.add_argument(
+        "--forecast_cache_size",
+        default=0,
+        type=int,
+        help="number of forecasts kept in the LRU cache of forecasts by history, 0 to "
+        "disable the cache",
+    )
+    parser.add_argument(
+        "--forecast_cache_file",
+        default="",
+        type=str,
+        help="npz file the forecast cache is loaded from and saved to between runs",
+    )
+    parser.add_argument(
+        "--arima_reselect_every",
+        default=1,
+        type=int,
+        help="search the ARIMA order of each node and feature again every this many "
+        "windows, refitting with the cached order in between (1: search every window)",
+    )
+    parser.add_argument(
+        "--arima_refit_every",
+        default=1,
+        type=int,
+        help="fit the ARIMA model of each node and feature on its whole history every "
+        "this many windows, updating it with each new observation in between "
+        "(1: fit every window)",
+    )
+    parser.add_argument(
+        "--live_host",
+        default="127.0.0.1",
+        type=str,
+        help="host of the Cooja serial socket or TCP stream of the border router",
+    )
+    parser.add_argument(
+        "--live_port",
+        default=60001,
+        type=int,
+        help="port of the Cooja serial socket or TCP stream of the border router",
+    )
+    parser.add_argument(
+        "--live_replay",
+        default="none",
+        type=str,
+        help="none: read the stream at live_host:live_port, serve: only replay the "
+        "traces of the chosen simulation at live_host:live_port, local: replay them "
+        "and read them in the same process",
+    )
+    parser.add_argument(
+        "--live_replay_speed",
+        default=0.0,
+        type=float,
+        help="simulated seconds replayed per second, 0 to replay as fast as possible",
+    )
+    parser.add_argument(
+        "--live_queue_size",
+        default=4,
+        type=int,
+        help="closed windows waiting for the IDS before the stream stops being read",
+    )
+    parser.add_argument(
+        "--live_max_latency",
+        default=0.0,
+        type=float,
+        help="seconds after which the remaining series of a window are not given to "
+        "the forecaster (0: no bound)",
+    )
+    parser.add_argument(
+        "--feature_store",
+        default="csv",
+        type=str,
+        help="format of parsed features: csv (files for each node) or npz "
+        "(single file for each simulation)",
+    )
 
     # Parameters feature regressor
     parser.add_argument(
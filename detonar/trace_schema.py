@@ -0,0 +1,69 @@
+"""
+Schema of the Cooja logs of the border router:
+statistics sent by each node (_stats.csv)
+DAOs received by the border router (_dao.csv)
+"""
+import pandas as pd
+
+# Times are kept as int64 since microseconds overflow int32 and lose precision as float32
+STATS_SCHEMA = {
+    "SENDER_ID": "category",
+    "TIME": "int64",
+    "DIO_rcvd": "int32",
+    "APP_rcvd": "int32",
+    "DAO_txd": "int32",
+    "DIO_txd": "int32",
+    "DIS_txd": "int32",
+    "APP_txd": "int32",
+    "CURRENT_RANK": "int32",
+    "CURRENT_VERSION": "int16",
+    "RANK_CHANGE_TIME": "int64",
+    "VERSION_CHANGE_TIME": "int64",
+    "NEIGHBORS": "object",
+}
+
+DAO_SCHEMA = {
+    "TIME": "int64",
+    "SOURCE_ID": "category",
+    "PARENT_ID": "category",
+}
+
+
+def _categorical_columns(schema):
+    return {column: dtype for column, dtype in schema.items() if dtype == "category"}
+
+
+def apply_schema(data, schema, name="trace"):
+    """
+    Check that all columns of the schema are present and cast them to the schema types.
+    Integer columns containing missing values are kept as floats.
+    """
+    missing = [column for column in schema if column not in data.columns]
+    if missing:
+        raise ValueError(f"{name} is missing columns: {missing}")
+    for column, dtype in schema.items():
+        if dtype == "category":
+            data[column] = data[column].astype("category")
+        elif dtype.startswith("int") and not data[column].isna().any():
+            data[column] = data[column].astype(dtype)
+    return data
+
+
+def read_stats(path_to_file, chunksize=None):
+    # Read statistics, or an iterator of chunks of statistics if chunksize is given
+    data = pd.read_csv(
+        path_to_file,
+        index_col=False,
+        dtype=_categorical_columns(STATS_SCHEMA),
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        return apply_schema(data, STATS_SCHEMA, str(path_to_file))
+    return (apply_schema(chunk, STATS_SCHEMA, str(path_to_file)) for chunk in data)
+
+
+def read_daos(path_to_file):
+    data = pd.read_csv(
+        path_to_file, index_col=False, dtype=_categorical_columns(DAO_SCHEMA)
+    )
+    return apply_schema(data, DAO_SCHEMA, str(path_to_file))